@@ -7,6 +7,11 @@ class KdlWagtailCoreConfig(AppConfig):
 
     def ready(self):
         self.hide_page_types()
+        self.register_signal_handlers()
+
+    def register_signal_handlers(self):
+        from .signal_handlers import register_signal_handlers
+        register_signal_handlers()
 
     def hide_page_types(self):
         '''Hide some Wagtail Pages types from the create new child page screen.
@@ -132,6 +132,15 @@ class ImageBlock(BaseCaptionAttributionBlock):
         template = 'kdl_wagtail_core/blocks/image_block.html'
         value_class = LinkBlockStructValue
 
+    def get_rendition_specs(self, value):
+        """
+        Returns the (image, filter spec) pairs rendered by the template.
+        """
+        if value.get('alignment') == 'full-width':
+            return [(value.get('image'), 'original')]
+
+        return [(value.get('image'), 'max-800x800')]
+
 
 class GalleryBlock(BaseStructBlock):
     images_block = ListBlock(ImageBlock())
@@ -140,6 +149,15 @@ class GalleryBlock(BaseStructBlock):
         icon = 'image'
         template = 'kdl_wagtail_core/blocks/gallery_block.html'
 
+    def get_rendition_specs(self, value):
+        """
+        Returns the (image, filter spec) pairs rendered by the template.
+        """
+        return [
+            (item.get('image'), 'fill-600x600')
+            for item in value.get('images_block')
+        ]
+
 
 class LinkBlock(BaseStructBlock):
     """
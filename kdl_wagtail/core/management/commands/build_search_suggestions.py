@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from kdl_wagtail.core import suggestions
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the prefix index of the titles suggested by the search pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of suggestions written per query",
+        )
+
+    def handle(self, *args, **options):
+        count = suggestions.rebuild_index(options["chunk_size"])
+
+        self.stdout.write(
+            self.style.SUCCESS("{} search suggestions written".format(count))
+        )
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from wagtail.core.models import Site
+
+from kdl_wagtail.core import sitemaps
+
+
+class Command(BaseCommand):
+    help = "Writes the XML sitemaps of the sites to disk"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--site",
+            type=int,
+            help="Id of the site to build the sitemaps for, defaults to all the sites",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=sitemaps.get_chunk_size(),
+            help="Maximum number of URLs per sitemap file",
+        )
+        parser.add_argument(
+            "--base-path",
+            default="/",
+            help="Path the sitemap files are served from, defaults to /",
+        )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.all()
+        if options["site"]:
+            sites = sites.filter(pk=options["site"])
+            if not sites:
+                raise CommandError("Site {} not found".format(options["site"]))
+
+        for site in sites:
+            self.build_sitemaps(site, options["base_path"], options["chunk_size"])
+
+    def build_sitemaps(self, site, base_path, chunk_size):
+        sections = sitemaps.write_sitemaps(
+            site, site.root_url + base_path, chunk_size=chunk_size
+        )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "{} sitemap files written for site {} in {}".format(
+                    sections, site, sitemaps.get_sitemap_dir(site)
+                )
+            )
+        )
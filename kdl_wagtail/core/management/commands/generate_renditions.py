@@ -0,0 +1,172 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+from wagtail.core.fields import StreamField
+from wagtail.images import get_image_model
+from wagtail.images.models import Filter
+
+CHUNK_SIZE = 500
+
+
+def init_worker():
+    django.setup()
+    # the connections inherited from the parent process can't be shared
+    connections.close_all()
+
+
+def generate_rendition(job):
+    image_id, spec = job
+    try:
+        get_image_model().objects.get(pk=image_id).get_rendition(spec)
+    except Exception as e:
+        return job, str(e)
+
+    return job, None
+
+
+class Command(BaseCommand):
+    help = "Generates the missing image renditions used by the templates"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of processes generating renditions, 0 to generate them in this process",
+        )
+        parser.add_argument(
+            "--progress-file",
+            help="File recording the generated renditions, they are skipped when the command is run again",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Finding the renditions used by the templates")
+
+        jobs = self.get_missing_renditions(self.get_renditions())
+
+        done = set()
+        progress_file = options["progress_file"]
+        if progress_file and os.path.exists(progress_file):
+            done = self.read_progress(progress_file)
+            jobs = [job for job in jobs if job not in done]
+
+        self.stdout.write("{} renditions to generate".format(len(jobs)))
+        if not jobs:
+            return
+
+        progress = open(progress_file, "a") if progress_file else None
+        errors = 0
+        try:
+            for count, (job, error) in enumerate(
+                self.generate_renditions(jobs, options["workers"]), 1
+            ):
+                if error:
+                    errors += 1
+                    self.stderr.write(
+                        "Image {}, {}: {}".format(job[0], job[1], error)
+                    )
+                elif progress:
+                    # the failed renditions are retried on the next run
+                    progress.write("{} {}\n".format(*job))
+                    progress.flush()
+                if count % 100 == 0:
+                    self.stdout.write("{}/{}".format(count, len(jobs)))
+        finally:
+            if progress:
+                progress.close()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "{} renditions generated, {} errors".format(
+                    len(jobs) - errors, errors
+                )
+            )
+        )
+
+    def get_renditions(self):
+        """
+        Returns the set of (image id, filter spec) used by the templates:
+        the `image_rendition_specs` of the models with an image and the
+        `get_rendition_specs` of the blocks in stream fields.
+        """
+        ret = set()
+
+        for model in apps.get_models():
+            specs = getattr(model, "image_rendition_specs", None)
+            if specs and "image" in [f.name for f in model._meta.concrete_fields]:
+                for image_id in (
+                    model.objects.exclude(image=None)
+                    .values_list("image_id", flat=True)
+                    .iterator()
+                ):
+                    ret.update((image_id, spec) for spec in specs)
+
+            # the inherited fields are scanned with the parent model, whose
+            # queryset includes the rows of its subclasses
+            for field in model._meta.local_concrete_fields:
+                if isinstance(field, StreamField):
+                    ret.update(self.get_stream_field_renditions(model, field))
+
+        return ret
+
+    def get_stream_field_renditions(self, model, field):
+        for obj in model.objects.only(field.attname).iterator():
+            for child in getattr(obj, field.attname):
+                get_rendition_specs = getattr(child.block, "get_rendition_specs", None)
+                if not get_rendition_specs:
+                    continue
+                for image, spec in get_rendition_specs(child.value):
+                    if image is not None:
+                        yield image.pk, spec
+
+    def get_missing_renditions(self, renditions):
+        """
+        Returns the `renditions` which don't exist in the database yet.
+        """
+        ImageModel = get_image_model()
+        Rendition = ImageModel.get_rendition_model()
+
+        by_image = {}
+        for image_id, spec in renditions:
+            by_image.setdefault(image_id, set()).add(spec)
+
+        ret = []
+        image_ids = sorted(by_image.keys())
+        for start in range(0, len(image_ids), CHUNK_SIZE):
+            chunk = image_ids[start:start + CHUNK_SIZE]
+            existing = set(
+                Rendition.objects.filter(image_id__in=chunk).values_list(
+                    "image_id", "filter_spec", "focal_point_key"
+                )
+            )
+            for image in ImageModel.objects.filter(pk__in=chunk):
+                for spec in sorted(by_image[image.pk]):
+                    key = Filter(spec=spec).get_cache_key(image)
+                    if (image.pk, spec, key) not in existing:
+                        ret.append((image.pk, spec))
+
+        return ret
+
+    def generate_renditions(self, jobs, workers):
+        if not workers:
+            for job in jobs:
+                yield generate_rendition(job)
+            return
+
+        connections.close_all()
+        with ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+            for result in executor.map(generate_rendition, jobs, chunksize=10):
+                yield result
+
+    def read_progress(self, progress_file):
+        ret = set()
+        with open(progress_file) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    ret.add((int(parts[0]), parts[1]))
+        return ret
@@ -0,0 +1,15 @@
+from .sites import get_site
+
+
+class SiteMiddleware(object):
+    '''
+    Resolves the site of the request from the map of the sites kept by the
+    process rather than with a query, see `kdl_wagtail.core.sites`.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        get_site(request)
+        return self.get_response(request)
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('kdl_wagtail_core', '0024_auto_20211008_1759'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchSuggestion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('title', models.CharField(max_length=255)),
+                ('position', models.PositiveSmallIntegerField()),
+                ('term', models.CharField(db_index=True, max_length=255)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchsuggestion',
+            index=models.Index(fields=['content_type', 'object_id'], name='kdl_wagtail_content_3f05df_idx'),
+        ),
+    ]
@@ -1,7 +1,18 @@
+import hashlib
+import json
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
+from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.db import models
+from django.db.models import prefetch_related_objects
 from modelcluster.fields import ParentalKey
 from wagtail.admin.edit_handlers import (
     FieldPanel,
@@ -13,6 +24,7 @@ from wagtail.admin.edit_handlers import (
 )
 from wagtail.api import APIField
 from wagtail.contrib.forms.forms import FormBuilder
+from wagtail.contrib.routable_page.models import RoutablePageMixin, route
 from wagtail.contrib.forms.models import (
     FORM_FIELD_CHOICES,
     AbstractEmailForm,
@@ -20,13 +32,18 @@ from wagtail.contrib.forms.models import (
 )
 from wagtail.contrib.settings.models import BaseSetting, register_setting
 from wagtail.core.fields import RichTextField, StreamField
-from wagtail.core.models import Page, Site
+from wagtail.core.models import Page
 from wagtail.images.edit_handlers import ImageChooserPanel
-from wagtail.images.models import Image
+from wagtail.images.models import Image, SourceImageIOError
 from wagtail.search import index
 
+from . import suggestions
 from .blocks import BaseStreamBlock
-from .utils import paginate
+from .sites import get_site
+from .utils import (
+    CURSOR_PARAM, build_page_tree, cached_count, get_fragment_cache, paginate,
+    paginate_keyset, prefetch_images, prefetch_renditions
+)
 
 
 class BasePage(Page):
@@ -34,6 +51,10 @@ class BasePage(Page):
     A base page model, to be extended, it contains two default fields, an
     introduction text field and an image.
     """
+    # filter specs of the renditions of `image` used by the templates, in the
+    # page header and in listings
+    image_rendition_specs = ['width-1024', 'fill-180x180-c100']
+
     introduction = models.TextField(
         help_text='Text to describe the page', blank=True
     )
@@ -63,7 +84,27 @@ class BasePage(Page):
 class BaseIndexPage(BasePage):
     """
     A base index page model.
+
+    Set `pagination_keyset` to the name of an ordering field (e.g. 'path')
+    to paginate the children with a cursor instead of page numbers, which
+    keeps deep pages fast on large indexes. `pagination_count` then tells
+    how the total number of children is obtained for the pagination:
+    'exact' (a COUNT query), 'cached' (a COUNT query cached for
+    `pagination_count_timeout` seconds), 'estimate' (the number of children
+    stored in the tree, may include non-live pages) or None (no count).
+
+    The images of the children on the current page and their renditions
+    for `children_rendition_specs` are fetched in bulk. Subclasses can list
+    extra relations to prefetch in `children_prefetch_related` (they must
+    exist on all the children types) or override `prefetch_children`.
     """
+    pagination_keyset = None
+    pagination_count = 'cached'
+    pagination_count_timeout = 300
+
+    children_rendition_specs = ['fill-180x180-c100']
+    children_prefetch_related = []
+
     class Meta:
         abstract = True
 
@@ -79,7 +120,47 @@ class BaseIndexPage(BasePage):
         return context
 
     def _paginate(self, request):
-        return paginate(self.children(), request.GET.get('page'))
+        if self.pagination_keyset:
+            ret = paginate_keyset(
+                self.children(), request.GET.get(CURSOR_PARAM),
+                key=self.pagination_keyset, count=self._get_children_count
+            )
+        else:
+            ret = paginate(self.children(), request.GET.get('page'))
+
+        if ret:
+            ret.object_list = list(ret.object_list)
+            self.prefetch_children(ret.object_list)
+
+        return ret
+
+    def prefetch_children(self, children):
+        """
+        Fetches in bulk the related objects used to list the `children`.
+        """
+        images = prefetch_images(children)
+        prefetch_renditions(images, *self.children_rendition_specs)
+
+        if self.children_prefetch_related:
+            prefetch_related_objects(
+                children, *self.children_prefetch_related
+            )
+
+    def _get_children_count(self):
+        if self.pagination_count == 'exact':
+            return self.children().count()
+
+        if self.pagination_count == 'cached':
+            return cached_count(
+                self.children(),
+                'kdl_wagtail_index_count_{}'.format(self.pk),
+                self.pagination_count_timeout
+            )
+
+        if self.pagination_count == 'estimate':
+            return self.numchild
+
+        return None
 
 
 class IndexPage(BaseIndexPage):
@@ -119,7 +200,21 @@ class BaseStreamPage(BasePage):
     """
     A base rich text page with a stream field body with blocks defined in
     `blocks.BaseStreamBlock`.
+
+    The rendered HTML of the body can be cached: set `body_cache_timeout` to
+    cache the whole body and/or `block_cache_timeout` to cache each block,
+    for that number of seconds. The cache is keyed by the live revision of
+    the page so publishing a new revision invalidates it. Changes to
+    related objects (e.g. an image or a linked page) are only visible
+    once the cache expires.
+
+    Before the body is rendered, the renditions used by its blocks (see
+    `get_rendition_specs` in `blocks`) are fetched in one query, and the
+    missing ones are generated.
     """
+    body_cache_timeout = None
+    block_cache_timeout = None
+
     body = StreamField(BaseStreamBlock(), verbose_name='Page body', blank=True)
 
     api_fields = BasePage.api_fields + [
@@ -137,66 +232,517 @@ class BaseStreamPage(BasePage):
     class Meta:
         abstract = True
 
+    def get_context(self, request, *args, **kwargs):
+        context = super().get_context(request, *args, **kwargs)
+        context['body_cache_key'] = self.get_body_cache_key(request)
+
+        if not self.is_body_cached(context['body_cache_key']):
+            self.prefetch_body_renditions()
+
+        return context
+
+    def is_body_cached(self, body_cache_key):
+        if not body_cache_key or not self.body_cache_timeout:
+            return False
+
+        return make_template_fragment_key(
+            'kdl_wagtail_page_body', [body_cache_key]
+        ) in get_fragment_cache()
+
+    def prefetch_body_renditions(self):
+        """
+        Fetches in bulk the renditions needed to render the body.
+        """
+        pairs = []
+        for child in self.body:
+            get_rendition_specs = getattr(
+                child.block, 'get_rendition_specs', None
+            )
+            if get_rendition_specs:
+                pairs.extend(
+                    (image, spec)
+                    for image, spec in get_rendition_specs(child.value)
+                    if image is not None
+                )
+
+        prefetch_renditions(
+            [image for image, _ in pairs], *set(spec for _, spec in pairs)
+        )
+
+        for image, spec in pairs:
+            try:
+                image.get_rendition(spec)
+            except SourceImageIOError:
+                # left to the image template tag to handle
+                pass
+
+    def get_body_cache_key(self, request):
+        """
+        Returns the key of the cached body, None if it should not be cached.
+        """
+        if not (self.body_cache_timeout or self.block_cache_timeout):
+            return None
+
+        if getattr(request, 'is_preview', False) or not self.live_revision_id:
+            return None
+
+        return '{}-{}-{}'.format(
+            request.get_host(), self.pk, self.live_revision_id
+        )
+
 
 class StreamPage(BaseStreamPage):
     pass
 
 
+class CachedSetting(BaseSetting):
+    '''
+    A site setting which is cached per site, in the process for
+    `KDL_WAGTAIL_SETTINGS_LOCAL_TIMEOUT` seconds (default 60) and in the
+    django cache until the setting is saved or deleted.
+    '''
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def for_site_cached(cls, site):
+        if not site:
+            return None
+
+        local_cache = cls.__dict__.get('_local_cache')
+        if local_cache is None:
+            local_cache = cls._local_cache = {}
+
+        now = time.monotonic()
+        entry = local_cache.get(site.pk)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        cache_key = cls.get_cache_key(site.pk)
+        ret = cache.get(cache_key)
+        if ret is None:
+            ret = cls.for_site(site)
+            cache.set(cache_key, ret, None)
+
+        timeout = getattr(settings, 'KDL_WAGTAIL_SETTINGS_LOCAL_TIMEOUT', 60)
+        local_cache[site.pk] = (now + timeout, ret)
+
+        return ret
+
+    @classmethod
+    def get_cache_key(cls, site_id):
+        return 'kdl_wagtail_setting_{}_{}_{}'.format(
+            cls._meta.app_label, cls._meta.model_name, site_id
+        )
+
+    @classmethod
+    def invalidate_cache(cls, site_id):
+        cls.__dict__.get('_local_cache', {}).pop(site_id, None)
+        cache.delete(cls.get_cache_key(site_id))
+
+
 @register_setting
-class AnalyticsSettings(BaseSetting):
+class AnalyticsSettings(CachedSetting):
     analytics_id = models.CharField(max_length=255)
 
 
 @register_setting
-class FooterSettings(BaseSetting):
+class FooterSettings(CachedSetting):
     body = RichTextField()
 
 
-class BaseSearchPage(BasePage):
+class BaseSearchPage(RoutablePageMixin, BasePage):
     '''
     A basic front-end search page for CMS content.
     It searches for live Wagtail pages matching a query passed in the query
     string. Results are paginated.
 
+    The searched page types are `searchable_models` (defaults to the
+    KDL_WAGTAIL_SEARCHABLE_MODELS setting, or all the page types). The hits
+    are counted per page type by the search backend (`search_facets`) and
+    can be restricted to one with the `type` query string parameter
+    (e.g. ?type=kdl_wagtail_core.streampage). Only the displayed hits are
+    converted to their specific page type.
+
+    The `suggest/` sub-page (e.g. /search/suggest/?q=smi) returns, as JSON,
+    the titles of the pages and people starting with the query, for
+    search-as-you-type, from a prefix index rather than a full search.
+
+    The hits are ordered by relevance, or by one of the other
+    `search_orders` selected with the `order` query string parameter
+    (e.g. ?order=date). The ordering is done by the search backend.
+
     TODO:
-    add a facet for page types;
     templating mechanism for each result type;
-    narrow down searchable page types with settings variable;
     include other wagtail content like images or documents?
         (might need to switch to Haystack for that)
-    let user specify the order (relevance, date);
+
+    Set `pagination_keyset` to a filterable ordering field (e.g. 'path') to
+    paginate the hits with a cursor instead of page numbers. The hits are
+    then ordered by that field rather than by `search_orders`.
     '''
+    pagination_keyset = None
+
+    # orderings selectable with the `order` query string parameter, the
+    # first one is the default: None for relevance, otherwise the filter
+    # fields of the search index the hits are ordered by
+    search_orders = {
+        'relevance': None,
+        'date': ['-last_published_at'],
+    }
+
+    # page models searched, as classes or 'app_label.ModelName' strings
+    searchable_models = None
+
+    # filter specs of the renditions of the hit images in the listing
+    hits_rendition_specs = ['fill-180x180-c100']
+
+    # the ids of the hits are cached per site, phrase and page type for
+    # `search_cache_timeout` seconds (None to disable) or until a page is
+    # published or unpublished, unless there are more than
+    # `search_cache_max_hits`
+    search_cache_timeout = 60 * 5
+    search_cache_max_hits = 1000
+    search_phrase_max_length = 256
+
+    CACHE_VERSION_KEY = 'kdl_wagtail_search_version'
+
+    # default and maximum number of titles returned by `suggest`, and the
+    # minimum length of the query, shorter ones match too many titles
+    suggestions_limit = 10
+    suggestions_max_limit = 50
+    suggestions_min_length = 3
+
     class Meta:
         abstract = True
 
     def get_context(self, request, *args, **kwargs):
         ret = super(BaseSearchPage, self).get_context(request, *args, **kwargs)
 
-        hits = self.get_search_hits(request)
+        if self.pagination_keyset:
+            ret['hits'] = self._paginate_keyset(request)
+        elif not self.get_search_phrase(request):
+            # no need for the search backend to list all the pages
+            ordering = self.search_orders[self.get_search_order(request)]
+            hits = self._get_querryset(request).order_by(
+                *(ordering or ['path']))
+            ret['hits'] = paginate(
+                hits, request.GET.get('page', 1),
+                count=self._get_cached(
+                    request, 'count', hits.count, vary_on=['type'])
+            )
+        else:
+            hits = self._get_search_hit_ids(request)
+            ret['hits'] = paginate(hits, request.GET.get('page', 1))
+
+        if ret['hits']:
+            self.prefetch_hits(ret['hits'])
 
-        ret['hits'] = paginate(hits, request.GET.get('page', 1))
         ret['search_phrase'] = self.get_search_phrase(request)
+        ret['search_type'] = request.GET.get('type', '')
+        ret['search_order'] = self.get_search_order(request)
+        ret['search_orders'] = list(self.search_orders.keys())
+        ret['search_facets'] = self.get_search_facets(request)
 
         return ret
 
+    def _paginate_keyset(self, request):
+        query_set = self._get_querryset(request)
+
+        def search(queryset):
+            return self._search_queryset(
+                request, queryset, order_by_relevance=False
+            )
+
+        def count():
+            return search(query_set).count()
+
+        return paginate_keyset(
+            query_set, request.GET.get(CURSOR_PARAM),
+            key=self.pagination_keyset, count=count, search=search
+        )
+
     def get_search_hits(self, request):
+        '''Returns the hits of the search, ordered by the search backend.'''
         query_set = self._get_querryset(request)
-        ret = self._search_queryset(request, query_set)
+        ordering = self.search_orders[self.get_search_order(request)]
+        if ordering:
+            ret = self._search_queryset(
+                request, query_set.order_by(*ordering),
+                order_by_relevance=False
+            )
+        else:
+            ret = self._search_queryset(request, query_set)
+
+        return ret
+
+    def _get_search_hit_ids(self, request):
+        '''
+        Returns the hits of the search as a list of (page id, content type
+        id), cached, if there are at most `search_cache_max_hits`, see
+        `prefetch_hits`. Otherwise returns `get_search_hits`.
+        '''
+        hits = self.get_search_hits(request)
+
+        if self.search_cache_timeout is None:
+            return hits
+
+        def get_hit_ids():
+            if hits.count() > self.search_cache_max_hits:
+                return False
+            return [(hit.pk, hit.content_type_id) for hit in hits]
+
+        ret = self._get_cached(request, 'hits', get_hit_ids)
+        if ret is False:
+            return hits
+
         return ret
 
     def get_search_phrase(self, request):
-        return request.GET.get('q', '').strip()
+        '''Returns the search phrase, with its white spaces normalised.'''
+        ret = ' '.join(request.GET.get('q', '').split())
+        return ret[:self.search_phrase_max_length]
+
+    def get_search_order(self, request):
+        '''Returns the selected key of `search_orders`.'''
+        ret = request.GET.get('order')
+        if ret not in self.search_orders:
+            ret = next(iter(self.search_orders))
+        return ret
+
+    def _get_cached(self, request, name, get_value,
+                    vary_on=('phrase', 'type', 'order')):
+        '''
+        Returns the value returned by get_value(), cached per site, search
+        page and the parameters of the search it depends on (`vary_on`,
+        among the phrase, page type and order). A value of None isn't
+        cached.
+        '''
+        if self.search_cache_timeout is None:
+            return get_value()
+
+        site = get_site(request)
+        params = []
+        if 'phrase' in vary_on:
+            params.append(self.get_search_phrase(request).lower())
+        if 'type' in vary_on:
+            content_type = self.get_search_type(request)
+            params.append(content_type.pk if content_type else None)
+        if 'order' in vary_on:
+            params.append(self.get_search_order(request))
+        key = hashlib.md5(json.dumps(params).encode('utf-8')).hexdigest()
+        cache_key = 'kdl_wagtail_search_{}_{}_{}_{}_{}'.format(
+            cache.get(self.CACHE_VERSION_KEY, 0), site.pk if site else 0,
+            self.pk, name, key
+        )
+
+        ret = cache.get(cache_key)
+        if ret is None:
+            ret = get_value()
+            if ret is not None:
+                cache.set(cache_key, ret, self.search_cache_timeout)
+
+        return ret
+
+    @classmethod
+    def invalidate_search_cache(cls):
+        try:
+            cache.incr(cls.CACHE_VERSION_KEY)
+        except ValueError:
+            cache.set(cls.CACHE_VERSION_KEY, 1, None)
+
+    def get_searchable_models(self):
+        models = self.searchable_models
+        if models is None:
+            models = getattr(settings, 'KDL_WAGTAIL_SEARCHABLE_MODELS', None)
+        if not models:
+            return []
+
+        return [
+            apps.get_model(model) if isinstance(model, str) else model
+            for model in models
+        ]
+
+    def get_search_type(self, request):
+        '''
+        Returns the content type selected with the `type` query string
+        parameter, None if it is missing or not a searchable page type.
+        '''
+        try:
+            app_label, model = request.GET.get('type', '').lower().split('.')
+            ret = ContentType.objects.get_by_natural_key(app_label, model)
+        except (ValueError, ContentType.DoesNotExist):
+            return None
+
+        model = ret.model_class()
+        searchable_models = self.get_searchable_models() or [Page]
+        if model is None or not issubclass(model, tuple(searchable_models)):
+            return None
+
+        return ret
+
+    @route(r'^suggest/$')
+    def suggest(self, request):
+        '''
+        Returns, as JSON, the titles of the pages and other objects (e.g.
+        people) matching the beginning of the `q` query string parameter,
+        for search-as-you-type. See `kdl_wagtail.core.suggestions`.
+        '''
+        try:
+            limit = int(request.GET.get('limit', self.suggestions_limit))
+        except ValueError:
+            limit = self.suggestions_limit
+        limit = max(1, min(limit, self.suggestions_max_limit))
+
+        content_types = None
+        models = self.get_searchable_models()
+        if models:
+            # the subclasses too, as with the search, see PageQuerySet.type
+            models = [
+                model for model in apps.get_models()
+                if issubclass(model, tuple(models))
+            ]
+            content_types = list(ContentType.objects.get_for_models(
+                *models, *suggestions.get_suggestion_models()).values())
+
+        hits = suggestions.get_suggestions(
+            self.get_search_phrase(request), limit, content_types,
+            min_length=self.suggestions_min_length)
+        urls = self._get_suggestion_urls(request, hits)
+
+        return JsonResponse({'suggestions': [
+            {
+                'title': hit['title'],
+                'type': '{}.{}'.format(
+                    *ContentType.objects.get_for_id(
+                        hit['content_type']).natural_key()),
+                'url': urls.get((hit['content_type'], hit['object_id'])),
+            }
+            for hit in hits
+        ]})
+
+    def _get_suggestion_urls(self, request, hits):
+        '''
+        Returns the urls of the suggested objects keyed by (content type
+        id, object id), with a query per type of objects.
+        '''
+        by_type = {}
+        for hit in hits:
+            by_type.setdefault(hit['content_type'], []).append(
+                hit['object_id'])
+
+        ret = {}
+        page_ids = {}
+        for content_type_id, pks in by_type.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is None:
+                continue
+            if issubclass(model, Page):
+                page_ids.update((pk, content_type_id) for pk in pks)
+            elif hasattr(model, 'get_absolute_url'):
+                for pk, obj in model.objects.in_bulk(pks).items():
+                    ret[(content_type_id, pk)] = obj.get_absolute_url()
+
+        # the url of a page doesn't depend on its specific type
+        for page in Page.objects.filter(pk__in=page_ids.keys()):
+            ret[(page_ids[page.pk], page.pk)] = page.get_url(request)
+
+        return ret
+
+    def get_search_facets(self, request):
+        '''
+        Returns the number of hits per page type, most hits first, as a list
+        of dictionaries with the `type` parameter value, label, count and
+        whether the type is selected. The counts are computed by the search
+        backend, regardless of the selected type.
+        '''
+        hits = self._search_queryset(
+            request, self._get_searchable_queryset(), order_by_relevance=False
+        )
+        try:
+            counts = self._get_cached(
+                request, 'facets',
+                lambda: list(hits.facet('content_type_id').items()),
+                vary_on=['phrase']
+            )
+        except NotImplementedError:
+            return []
+
+        selected = self.get_search_type(request)
+
+        ret = []
+        for content_type_id, count in counts:
+            if not count:
+                continue
+            content_type = ContentType.objects.get_for_id(content_type_id)
+            model = content_type.model_class()
+            if model is None:
+                continue
+            ret.append({
+                'type': '{}.{}'.format(
+                    content_type.app_label, content_type.model),
+                'label': model._meta.verbose_name_plural,
+                'count': count,
+                'selected': content_type == selected,
+            })
+
+        return ret
+
+    def prefetch_hits(self, hits):
+        '''
+        Replaces the displayed `hits` (a page of generic pages or of cached
+        (page id, content type id), see `get_search_hits`) with their
+        specific pages, with a query per page type, and fetches in bulk the
+        related objects used to list them.
+        '''
+        pages = list(hits.object_list)
+
+        by_type = {}
+        for page in pages:
+            if isinstance(page, tuple):
+                by_type.setdefault(page[1], []).append(page[0])
+            elif page.specific_class is not type(page):
+                by_type.setdefault(page.content_type_id, []).append(page.pk)
+
+        specific = {}
+        for content_type_id, pks in by_type.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is not None:
+                specific.update(model.objects.in_bulk(pks))
+
+        hits.object_list = []
+        for page in pages:
+            if isinstance(page, tuple):
+                # the page may have been deleted since it was cached
+                page = specific.get(page[0])
+                if page is not None:
+                    hits.object_list.append(page)
+            else:
+                hits.object_list.append(specific.get(page.pk, page))
+
+        images = prefetch_images(hits.object_list)
+        prefetch_renditions(images, *self.hits_rendition_specs)
+
+    def _get_searchable_queryset(self):
+        ret = Page.objects.exclude(depth=1).live()
+        models = self.get_searchable_models()
+        if models:
+            ret = ret.type(*models)
+        return ret
 
     def _get_querryset(self, request):
-        ret = Page.objects.exclude(depth=1).live().specific()
+        ret = self._get_searchable_queryset()
+        content_type = self.get_search_type(request)
+        if content_type:
+            ret = ret.filter(content_type=content_type)
         return ret
 
-    def _search_queryset(self, request, queryset):
+    def _search_queryset(self, request, queryset, order_by_relevance=True):
         from wagtail.search.query import MATCH_ALL
         phrase = self.get_search_phrase(request)
         if not phrase:
             phrase = MATCH_ALL
-        ret = queryset.search(phrase)
+        ret = queryset.search(phrase, order_by_relevance=order_by_relevance)
         return ret
 
 
@@ -204,20 +750,75 @@ class SearchPage(BaseSearchPage):
     pass
 
 
+class SearchSuggestion(models.Model):
+    '''
+    An entry of the prefix index of the titles suggested by
+    `BaseSearchPage.suggest`: the normalised title of a page or object
+    from its word number `position` onwards. See
+    `kdl_wagtail.core.suggestions`.
+    '''
+    content_type = models.ForeignKey(
+        ContentType, on_delete=models.CASCADE, related_name='+'
+    )
+    object_id = models.PositiveIntegerField()
+    title = models.CharField(max_length=255)
+    position = models.PositiveSmallIntegerField()
+    term = models.CharField(max_length=255, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['content_type', 'object_id'])]
+
+    def __str__(self):
+        return self.term
+
+
 class SitemapPage(Page):
+    '''
+    An HTML sitemap of the live pages of the current site.
+
+    The tree of pages is built with a single query and cached per site until
+    a page is published, unpublished or moved.
+    `sitemap_max_depth` limits the number of levels shown.
+    '''
+    sitemap_max_depth = None
+    sitemap_cache_timeout = 60 * 60 * 24
+
+    CACHE_VERSION_KEY = 'kdl_wagtail_sitemap_version'
+
     def get_context(self, request, *args, **kwargs):
         context = super(SitemapPage, self).get_context(
             request, *args, **kwargs)
 
-        site = Site.find_for_request(request)
+        site = get_site(request)
         if not site:
             return context
 
-        context['children'] = site.root_page.get_children(
-        ).live().order_by('title')
+        context['children'] = self.get_sitemap_tree(site, request)
 
         return context
 
+    def get_sitemap_tree(self, site, request=None):
+        cache_key = 'kdl_wagtail_sitemap_{}_{}_{}'.format(
+            cache.get(self.CACHE_VERSION_KEY, 0), site.pk,
+            self.sitemap_max_depth
+        )
+
+        ret = cache.get(cache_key)
+        if ret is None:
+            ret = build_page_tree(
+                site.root_page, request, max_depth=self.sitemap_max_depth
+            )
+            cache.set(cache_key, ret, self.sitemap_cache_timeout)
+
+        return ret
+
+    @classmethod
+    def invalidate_sitemap_cache(cls):
+        try:
+            cache.incr(cls.CACHE_VERSION_KEY)
+        except ValueError:
+            cache.set(cls.CACHE_VERSION_KEY, 1, None)
+
 
 # --------------------------------------------------------------------------
 #                   Form Builder & derived pages
@@ -346,6 +947,8 @@ class ProxyPageAbstract(BasePage):
         '''Returns the URL of the target. None if not defined.'''
         ret = None
         if self.target_page:
+            # Wagtail finds the site on the request
+            get_site(request)
             ret = self.target_page.get_full_url(request)
         if self.target_url:
             ret = self.target_url
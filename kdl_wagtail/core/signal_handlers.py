@@ -0,0 +1,97 @@
+from django.apps import apps
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from wagtail.core.models import Page, Site
+from wagtail.core.signals import (
+    page_published, page_unpublished, post_page_move
+)
+
+
+def invalidate_sitemap(**kwargs):
+    from .models import SitemapPage
+    SitemapPage.invalidate_sitemap_cache()
+
+
+def invalidate_search(**kwargs):
+    from .models import BaseSearchPage
+    BaseSearchPage.invalidate_search_cache()
+
+
+def index_suggestions(instance, **kwargs):
+    from . import suggestions
+    suggestions.index_object(instance)
+
+
+def remove_suggestions(instance, **kwargs):
+    from . import suggestions
+    suggestions.remove_object(instance)
+
+
+def invalidate_sites(**kwargs):
+    from .sites import invalidate_site_map
+    invalidate_site_map()
+
+
+def invalidate_site_root(instance, **kwargs):
+    from .sites import get_site_map, invalidate_site_map
+    if instance.pk in get_site_map().root_page_ids:
+        invalidate_site_map()
+
+
+def invalidate_setting(sender, instance, **kwargs):
+    sender.invalidate_cache(instance.site_id)
+
+
+def reset_krackdown(setting, **kwargs):
+    if setting == 'KDL_WAGTAIL_KRACKDOWN_FILTERS':
+        from .utils import clear_krackdown_cache
+        clear_krackdown_cache()
+
+
+def register_signal_handlers():
+    from .models import CachedSetting
+    from .suggestions import get_suggestion_models
+
+    for model in apps.get_models():
+        if issubclass(model, CachedSetting):
+            post_save.connect(invalidate_setting, sender=model)
+            post_delete.connect(invalidate_setting, sender=model)
+
+    for model in get_suggestion_models():
+        post_save.connect(
+            index_suggestions, sender=model,
+            dispatch_uid='kdl_wagtail_suggestions_saved_{}'.format(
+                model._meta.label_lower))
+        post_delete.connect(
+            remove_suggestions, sender=model,
+            dispatch_uid='kdl_wagtail_suggestions_removed_{}'.format(
+                model._meta.label_lower))
+
+    page_published.connect(
+        invalidate_sitemap, dispatch_uid='kdl_wagtail_sitemap_published')
+    page_unpublished.connect(
+        invalidate_sitemap, dispatch_uid='kdl_wagtail_sitemap_unpublished')
+    post_page_move.connect(
+        invalidate_sitemap, dispatch_uid='kdl_wagtail_sitemap_moved')
+    page_published.connect(
+        invalidate_search, dispatch_uid='kdl_wagtail_search_published')
+    page_unpublished.connect(
+        invalidate_search, dispatch_uid='kdl_wagtail_search_unpublished')
+    page_published.connect(
+        index_suggestions, dispatch_uid='kdl_wagtail_suggestions_published')
+    page_unpublished.connect(
+        remove_suggestions, dispatch_uid='kdl_wagtail_suggestions_unpublished')
+    post_delete.connect(
+        remove_suggestions, sender=Page,
+        dispatch_uid='kdl_wagtail_suggestions_deleted')
+    post_save.connect(
+        invalidate_sites, sender=Site, dispatch_uid='kdl_wagtail_sites_saved')
+    post_delete.connect(
+        invalidate_sites, sender=Site,
+        dispatch_uid='kdl_wagtail_sites_deleted')
+    page_published.connect(
+        invalidate_site_root, dispatch_uid='kdl_wagtail_site_root_published')
+    post_page_move.connect(
+        invalidate_site_root, dispatch_uid='kdl_wagtail_site_root_moved')
+    setting_changed.connect(
+        reset_krackdown, dispatch_uid='kdl_wagtail_krackdown_settings')
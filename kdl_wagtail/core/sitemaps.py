@@ -0,0 +1,193 @@
+'''
+XML sitemaps (https://www.sitemaps.org/protocol.html) for large sites.
+
+The live pages of a site are streamed from the database and written as a
+sitemap index (sitemap.xml) and sections of at most `chunk_size` URLs
+(sitemap-1.xml, sitemap-2.xml, ...), without loading all the pages in
+memory. The files are served by the `views.sitemap_xml` view, either
+prebuilt to disk by the `build_sitemaps` management command or generated
+on the fly.
+'''
+import itertools
+import os
+import re
+from xml.sax.saxutils import escape
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max, Q
+
+# maximum number of URLs in a sitemap file allowed by the protocol
+SITEMAP_CHUNK_SIZE = 50000
+
+SITEMAP_INDEX_FILE = 'sitemap.xml'
+SITEMAP_SECTION_FILE = 'sitemap-{}.xml'
+SITEMAP_FILE_RE = re.compile(r'^sitemap(?:-(\d+))?\.xml$')
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+XML_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def get_chunk_size():
+    return getattr(settings, 'KDL_WAGTAIL_SITEMAP_CHUNK_SIZE',
+                   SITEMAP_CHUNK_SIZE)
+
+
+def get_sitemap_dir(site):
+    '''Returns the directory where the sitemap files of the site are stored.
+    '''
+    root = getattr(settings, 'KDL_WAGTAIL_SITEMAP_ROOT', None)
+    if root is None:
+        root = os.path.join(settings.MEDIA_ROOT, 'sitemaps')
+    return os.path.join(root, str(site.pk))
+
+
+def get_sitemap_pages(site):
+    '''
+    Returns a queryset of the live and public pages of the site in tree
+    order.
+
+    Proxy pages are left out as they only redirect to their target. The
+    live and public target pages of the proxies of the site are listed
+    instead, once, if they aren't already listed in their own right (e.g.
+    pages of another site). External target URLs don't belong in the
+    sitemap of this site.
+    '''
+    from wagtail.core.models import Page
+    from .models import ProxyPageAbstract
+
+    proxy_models = [
+        model for model in apps.get_models()
+        if issubclass(model, ProxyPageAbstract)
+    ]
+
+    in_site = Q(path__startswith=site.root_page.path)
+    listed = in_site
+    for model in proxy_models:
+        listed |= Q(pk__in=model.objects.live().public().filter(
+            in_site, target_page__isnull=False
+        ).values('target_page_id'))
+
+    ret = Page.objects.live().public().filter(listed).exclude(
+        content_type__in=ContentType.objects.get_for_models(
+            *proxy_models).values()
+    ).order_by('path').only('path', 'url_path', 'last_published_at')
+
+    return ret
+
+
+def iter_sitemap_xml(pages, request=None):
+    '''Yields the XML of a sitemap listing the urls of `pages`.'''
+    yield XML_HEADER
+    yield '<urlset xmlns="{}">\n'.format(XML_NS)
+
+    for page in pages:
+        url = page.get_full_url(request)
+        if not url:
+            continue
+
+        entry = '<url><loc>{}</loc>'.format(escape(url))
+        if page.last_published_at:
+            entry += '<lastmod>{}</lastmod>'.format(
+                page.last_published_at.date().isoformat())
+        yield entry + '</url>\n'
+
+    yield '</urlset>\n'
+
+
+def iter_sitemap_index_xml(base_url, sections):
+    '''Yields the XML of a sitemap index of `sections` sitemap files found
+    under `base_url`.'''
+    yield XML_HEADER
+    yield '<sitemapindex xmlns="{}">\n'.format(XML_NS)
+
+    for section in range(1, sections + 1):
+        yield '<sitemap><loc>{}</loc></sitemap>\n'.format(
+            escape(base_url + SITEMAP_SECTION_FILE.format(section)))
+
+    yield '</sitemapindex>\n'
+
+
+def get_sitemap_sections(pages, chunk_size=None):
+    '''
+    Returns the number of sitemap files needed to list `pages` with
+    `get_sitemap_section_pages`.
+
+    The sections are ranges of `chunk_size` page ids, so the number of
+    sections is found from the highest page id, without counting the
+    pages. Some sections can therefore list fewer pages, or none.
+    '''
+    chunk_size = chunk_size or get_chunk_size()
+    last_pk = pages.model.objects.aggregate(last_pk=Max('pk'))['last_pk']
+    return max(1, -(-(last_pk or 0) // chunk_size))
+
+
+def get_sitemap_section_pages(pages, section, chunk_size=None):
+    '''
+    Returns the `pages` listed in the sitemap file number `section`, those
+    with an id in its range, fetched by id instead of with an OFFSET.
+    '''
+    chunk_size = chunk_size or get_chunk_size()
+    last_pk = (section - 1) * chunk_size
+    return pages.filter(
+        pk__gt=last_pk, pk__lte=last_pk + chunk_size
+    ).order_by('pk').iterator()
+
+
+def write_sitemaps(site, base_url, directory=None, chunk_size=None):
+    '''
+    Writes the sitemap index and sections of the site to `directory`
+    (defaults to `get_sitemap_dir`) in a single pass over its pages.
+    `base_url` is the URL the sections are served from.
+
+    Files are written under a temporary name and then renamed, so
+    complete files can be served while they are rebuilt.
+
+    Returns the number of sections.
+    '''
+    chunk_size = chunk_size or get_chunk_size()
+    directory = directory or get_sitemap_dir(site)
+    os.makedirs(directory, exist_ok=True)
+
+    pages = get_sitemap_pages(site).iterator(chunk_size=2000)
+
+    sections = 0
+    while True:
+        first = next(pages, None)
+        if first is None and sections:
+            break
+
+        sections += 1
+        chunk = []
+        if first is not None:
+            chunk = itertools.chain([first], itertools.islice(
+                pages, chunk_size - 1))
+        _write_file(
+            directory, SITEMAP_SECTION_FILE.format(sections),
+            iter_sitemap_xml(chunk)
+        )
+
+        if first is None:
+            break
+
+    _write_file(
+        directory, SITEMAP_INDEX_FILE,
+        iter_sitemap_index_xml(base_url, sections)
+    )
+
+    # removes the sections left over from a previous, larger, build
+    for name in os.listdir(directory):
+        match = SITEMAP_FILE_RE.match(name)
+        if match and match.group(1) and int(match.group(1)) > sections:
+            os.remove(os.path.join(directory, name))
+
+    return sections
+
+
+def _write_file(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for part in content:
+            f.write(part)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,107 @@
+'''
+Resolution of the Wagtail site of a request without querying the database.
+
+`get_site` resolves the site of a request once and memoises it on the
+request, where `Site.find_for_request` also looks for it, so Wagtail (e.g.
+when building page URLs) reuses it too. The sites are looked up by
+hostname in a map kept by each process, with the same rules as
+`Site.find_for_request`.
+
+The map is reloaded when a site is saved or deleted, and when the root page
+of a site is published or moved. The version of the map is kept in the
+cache so that all the processes reload it, at the cost of a cache lookup
+per request. Add `kdl_wagtail.core.middleware.SiteMiddleware` to the
+settings to resolve the site of all the requests that way, including those
+served by Wagtail.
+
+The sites of the map are shared by the requests, they shouldn't be
+modified.
+'''
+import threading
+
+from django.core.cache import cache
+from django.http.request import split_domain_port
+
+CACHE_VERSION_KEY = 'kdl_wagtail_sites_version'
+
+_state = {'version': None, 'sites': None}
+_lock = threading.Lock()
+
+
+class SiteMap(object):
+    '''The sites, keyed by hostname, and the default site.'''
+
+    def __init__(self, sites):
+        self.by_hostname = {}
+        self.default = None
+        self.root_page_ids = set()
+
+        for site in sites:
+            self.by_hostname.setdefault(site.hostname, []).append(site)
+            if site.is_default_site:
+                self.default = site
+            self.root_page_ids.add(site.root_page_id)
+
+    def find(self, hostname, port):
+        '''
+        Returns the site of `hostname` and `port`, see
+        `wagtail.core.sites.get_site_for_hostname`, or None.
+        '''
+        matches = self.by_hostname.get(hostname, [])
+
+        for site in matches:
+            if site.port == port:
+                return site
+
+        if self.default is not None:
+            if self.default.hostname == hostname:
+                return self.default
+            # a unique site with that hostname is preferred to the default
+            if len(matches) == 1:
+                return matches[0]
+            return self.default
+
+        if len(matches) == 1:
+            return matches[0]
+
+        return None
+
+
+def get_site_map():
+    '''Returns the `SiteMap` of this process, reloaded if out of date.'''
+    from wagtail.core.models import Site
+
+    version = cache.get(CACHE_VERSION_KEY, 0)
+    ret = _state['sites']
+    if ret is None or _state['version'] != version:
+        with _lock:
+            ret = SiteMap(Site.objects.select_related('root_page'))
+            _state['sites'] = ret
+            _state['version'] = version
+
+    return ret
+
+
+def get_site(request):
+    '''Returns the site of the request, resolved once per request.'''
+    if request is None:
+        return None
+
+    if not hasattr(request, '_wagtail_site'):
+        hostname = split_domain_port(request.get_host())[0]
+        try:
+            port = int(request.get_port())
+        except ValueError:
+            port = None
+        request._wagtail_site = get_site_map().find(hostname, port)
+
+    return request._wagtail_site
+
+
+def invalidate_site_map():
+    '''Reloads the map of the sites in all the processes.'''
+    _state['sites'] = None
+    try:
+        cache.incr(CACHE_VERSION_KEY)
+    except ValueError:
+        cache.set(CACHE_VERSION_KEY, 1, None)
@@ -0,0 +1,169 @@
+'''
+Search suggestions (search-as-you-type) from a prefix index of titles.
+
+The index (`SearchSuggestion`) has a row per word of the title of the live
+pages and of the `search_suggestion_field` of the other models which
+declare one (e.g. the name of the people), with the normalised title from
+that word onwards. A title is therefore matched by the beginning of any of
+its words with an indexed `LIKE 'prefix%'` query instead of a full text
+search.
+
+The index is kept up to date by the signal handlers of the core app, when
+a page is published, unpublished or deleted and when an object of the
+other models is saved or deleted, and can be rebuilt with the
+`build_search_suggestions` management command.
+'''
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import IntegerField, Min, Value
+
+# maximum length of the indexed terms, see SearchSuggestion.term
+TERM_MAX_LENGTH = 255
+
+# minimum length of the phrases looked up, the shorter ones match too many
+# terms to be grouped and sorted quickly
+PHRASE_MIN_LENGTH = 3
+
+
+def normalise(text):
+    '''Returns `text` lowercased, with its white spaces normalised.'''
+    return ' '.join((text or '').lower().split())
+
+
+def get_terms(title):
+    '''
+    Returns the (position, term) of each word of `title`, the term being
+    the normalised title from that word onwards.
+    '''
+    words = normalise(title).split(' ')
+    return [
+        (position, ' '.join(words[position:])[:TERM_MAX_LENGTH])
+        for position in range(len(words))
+        if words[position]
+    ]
+
+
+def get_suggestion_models():
+    '''
+    Returns the models, other than pages, with a `search_suggestion_field`.
+    '''
+    from wagtail.core.models import Page
+
+    return [
+        model for model in apps.get_models()
+        if not issubclass(model, Page)
+        if getattr(model, 'search_suggestion_field', None)
+    ]
+
+
+def get_suggestion_title(obj):
+    field = getattr(obj, 'search_suggestion_field', None) or 'title'
+    return getattr(obj, field)
+
+
+def _get_suggestions(content_type_id, object_id, title):
+    from .models import SearchSuggestion
+
+    title = ' '.join((title or '').split())
+    return [
+        SearchSuggestion(
+            content_type_id=content_type_id, object_id=object_id,
+            title=title[:TERM_MAX_LENGTH], position=position, term=term
+        )
+        for position, term in get_terms(title)
+    ]
+
+
+def _get_content_type_id(obj):
+    # the specific type of pages
+    content_type_id = getattr(obj, 'content_type_id', None)
+    if content_type_id is None:
+        content_type_id = ContentType.objects.get_for_model(obj).pk
+    return content_type_id
+
+
+@transaction.atomic
+def index_object(obj):
+    '''Replaces the suggestions of a page or object with its title.'''
+    from .models import SearchSuggestion
+
+    content_type_id = _get_content_type_id(obj)
+    SearchSuggestion.objects.filter(
+        content_type_id=content_type_id, object_id=obj.pk
+    ).delete()
+    SearchSuggestion.objects.bulk_create(
+        _get_suggestions(content_type_id, obj.pk, get_suggestion_title(obj))
+    )
+
+
+def remove_object(obj):
+    '''Removes the suggestions of a page or object.'''
+    from .models import SearchSuggestion
+
+    SearchSuggestion.objects.filter(
+        content_type_id=_get_content_type_id(obj), object_id=obj.pk
+    ).delete()
+
+
+@transaction.atomic
+def rebuild_index(chunk_size=1000):
+    '''
+    Rebuilds the suggestions of all the live pages and of the objects of
+    the `get_suggestion_models`. Returns the number of suggestions.
+    '''
+    from wagtail.core.models import Page
+    from .models import SearchSuggestion
+
+    SearchSuggestion.objects.all().delete()
+
+    querysets = [
+        Page.objects.live().exclude(depth=1).values_list(
+            'content_type_id', 'pk', 'title')
+    ]
+    for model in get_suggestion_models():
+        content_type_id = ContentType.objects.get_for_model(model).pk
+        querysets.append(model.objects.values_list(
+            Value(content_type_id, output_field=IntegerField()), 'pk',
+            model.search_suggestion_field
+        ))
+
+    ret = 0
+    suggestions = []
+    for queryset in querysets:
+        for content_type_id, pk, title in queryset.iterator(chunk_size):
+            suggestions.extend(_get_suggestions(content_type_id, pk, title))
+            if len(suggestions) >= chunk_size:
+                SearchSuggestion.objects.bulk_create(suggestions)
+                ret += len(suggestions)
+                suggestions = []
+
+    SearchSuggestion.objects.bulk_create(suggestions)
+    ret += len(suggestions)
+
+    return ret
+
+
+def get_suggestions(phrase, limit=10, content_types=None,
+                    min_length=PHRASE_MIN_LENGTH):
+    '''
+    Returns the `limit` first titles matching the beginning of `phrase`,
+    as dictionaries with their `content_type`, `object_id` and `title`.
+    The titles starting with the phrase come first, then alphabetically.
+    Returns no titles if the phrase is shorter than `min_length`.
+    '''
+    from .models import SearchSuggestion
+
+    phrase = normalise(phrase)[:TERM_MAX_LENGTH]
+    if not phrase or len(phrase) < min_length:
+        return []
+
+    ret = SearchSuggestion.objects.filter(term__startswith=phrase)
+    if content_types is not None:
+        ret = ret.filter(content_type__in=content_types)
+
+    return list(
+        ret.values('content_type', 'object_id', 'title')
+        .annotate(position=Min('position'))
+        .order_by('position', 'title', 'object_id')[:limit]
+    )
@@ -1,12 +1,11 @@
 from django import template
-from django.conf import settings
+from django.http import QueryDict
 from django.template.defaultfilters import striptags, truncatechars
-from django.utils.module_loading import import_string
 from django.utils.safestring import mark_safe
-from wagtail.core.models import Site
 
 from kdl_wagtail.core.models import AnalyticsSettings, FooterSettings
-from kdl_wagtail.core.utils import paginate
+from kdl_wagtail.core.sites import get_site
+from kdl_wagtail.core.utils import CURSOR_PARAM, apply_krackdown_filters, paginate
 
 register = template.Library()
 
@@ -17,17 +16,13 @@ def get_analytics_id(context):
 
     request = context["request"]
     if request:
-        s = AnalyticsSettings.for_site(get_site(request))
+        s = AnalyticsSettings.for_site_cached(get_site(request))
         if s:
             analytics_id = s.analytics_id
 
     return {"analytics_id": analytics_id}
 
 
-def get_site(request):
-    return Site.find_for_request(request)
-
-
 @register.simple_tag()
 def get_block_title(block):
     if not block:
@@ -81,7 +76,7 @@ def get_footer_text(context):
 
     request = context["request"]
     if request:
-        s = FooterSettings.for_site(get_site(request))
+        s = FooterSettings.for_site_cached(get_site(request))
         if s:
             footer_text = s.body
 
@@ -89,7 +84,11 @@ def get_footer_text(context):
 
 
 @register.simple_tag(takes_context=True)
-def get_page_children(context, page):
+def get_page_children(context, page, keyset=None):
+    """Return the paginated live children of the page.
+    If `keyset` is the name of an ordering field (e.g. 'path') the children
+    are paginated with a cursor, see `kdl_wagtail.core.utils.paginate_keyset`.
+    """
     if not page:
         return None
 
@@ -97,7 +96,12 @@ def get_page_children(context, page):
     if not request:
         return None
 
-    return paginate(page.get_children().specific.live(), request.GET.get("page"))
+    children = page.get_children().specific().live()
+
+    if keyset:
+        return paginate(children, request.GET.get(CURSOR_PARAM), keyset=keyset)
+
+    return paginate(children, request.GET.get("page"))
 
 
 @register.simple_tag()
@@ -128,19 +132,29 @@ def get_object_id(obj, prefix=None, suffix=None):
 
 @register.filter()
 def krackdown(text):
-    filters = getattr(settings, "KDL_WAGTAIL_KRACKDOWN_FILTERS", [])
-
     if not isinstance(text, str):
         text = text.__html__()
 
-    for function_name in filters:
-        # not catching import errors to allow the propagation of the error
-        f = import_string(function_name)
-        text = f(text)
-
-    return mark_safe(text)
+    return mark_safe(apply_krackdown_filters(text))
 
 
 @register.filter()
 def order_by(value, arg):
     return value.order_by(arg)
+
+
+@register.simple_tag(takes_context=True)
+def url_replace(context, **kwargs):
+    """Return the query string of the current request with the given
+    parameters replaced, e.g. ?{% url_replace page=2 %}
+    Parameters set to None are removed.
+    """
+    request = context.get("request")
+    params = request.GET.copy() if request else QueryDict(mutable=True)
+
+    for key, value in kwargs.items():
+        params.pop(key, None)
+        if value is not None:
+            params[key] = value
+
+    return params.urlencode()
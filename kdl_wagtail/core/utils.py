@@ -1,20 +1,65 @@
+import base64
+import binascii
+import functools
 import json
+import math
 import re
 
 from django.conf import settings
 from django.contrib.contenttypes.management import create_contenttypes
+from django.core.cache import cache, caches
+from django.core.exceptions import ValidationError
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, QuerySet, prefetch_related_objects
+from django.utils.module_loading import import_string
+from wagtail.search.backends.base import BaseSearchResults
 
+# name of the query string parameter carrying a keyset pagination cursor
+CURSOR_PARAM = 'cursor'
 
-def paginate(items, page=1, page_size=10):
-    if not items:
+# ordering keys which are unique, no tie-breaker needed for keyset pagination
+UNIQUE_KEYSET_KEYS = ['path', 'pk', 'id']
+
+
+def paginate(items, page=1, page_size=10, keyset=None, count=None):
+    '''
+    Returns a page of `items`.
+
+    By default a django Paginator is used and `page` is a page number.
+
+    If `keyset` is the name of a field (e.g. 'path', or '-last_published_at'
+    for a descending order) the items are paginated with a keyset
+    (cursor) method instead, see `KeysetPaginator`. `items` must then be a
+    queryset and `page` is an opaque cursor (see `CURSOR_PARAM`).
+    `count` is the number of items if it is already known, an integer or a
+    callable, see `KeysetPaginator`. Otherwise the items are counted.
+    '''
+    if keyset:
+        return paginate_keyset(items, page, page_size, keyset, count)
+
+    if count is not None:
+        if callable(count):
+            count = count()
+        if not count:
+            return None
+    elif isinstance(items, QuerySet):
+        # avoids fetching all the rows just to know if there are any
+        if not items.exists():
+            return None
+    elif isinstance(items, BaseSearchResults):
+        # same for search results, the count is reused by the paginator
+        if not items.count():
+            return None
+    elif not items:
         return None
 
     if hasattr(settings, 'KDL_WAGTAIL_ITEMS_PER_PAGE'):
         page_size = settings.KDL_WAGTAIL_ITEMS_PER_PAGE
 
     paginator = Paginator(items, page_size)
+    if count is not None:
+        paginator.count = count
 
     try:
         pages = paginator.page(page)
@@ -26,7 +71,392 @@ def paginate(items, page=1, page_size=10):
     return pages
 
 
-def migrate_wagtail_page_type(apps, schema_editor, mapping):
+def paginate_keyset(items, cursor=None, page_size=10, key='path', count=None,
+                    search=None):
+    '''
+    Returns a page of `items` using keyset (cursor) pagination.
+
+    Unlike `paginate`, this never issues an OFFSET query and only counts
+    the items if asked to, see `KeysetPaginator`.
+    '''
+    if items is None:
+        return None
+
+    if hasattr(settings, 'KDL_WAGTAIL_ITEMS_PER_PAGE'):
+        page_size = settings.KDL_WAGTAIL_ITEMS_PER_PAGE
+
+    paginator = KeysetPaginator(
+        items, page_size, key=key, count=count, search=search
+    )
+    pages = paginator.page(cursor)
+    if not pages.object_list and not pages.has_previous():
+        return None
+
+    return pages
+
+
+def cached_count(queryset, cache_key, timeout=None):
+    '''
+    Returns queryset.count(), cached under `cache_key`.
+    '''
+    ret = cache.get(cache_key)
+    if ret is None:
+        ret = queryset.count()
+        cache.set(cache_key, ret, timeout)
+    return ret
+
+
+def get_fragment_cache():
+    '''
+    Returns the cache used by the `{% cache %}` template tag: the
+    'template_fragments' cache if there is one, otherwise the default cache.
+    '''
+    if 'template_fragments' in settings.CACHES:
+        return caches['template_fragments']
+    return caches['default']
+
+
+class KeysetPaginator(object):
+    '''
+    Paginates a queryset by filtering on the value of an ordering `key`
+    from the edge of the previous page rather than with OFFSET, so the cost
+    of a page doesn't depend on how deep it is.
+
+    `key` should be indexed and not null. A non unique key is
+    complemented with the primary key to break ties.
+
+    `count` is the total number of items, it can be an integer, a callable
+    (only called if the count is used) or None when unknown. When None,
+    only previous/next links can be offered.
+
+    `search` is an optional function applied to the filtered and ordered
+    queryset, e.g. to run a search on it. It must preserve the queryset
+    order and return something that can be sliced.
+    '''
+
+    def __init__(self, queryset, per_page, key='path', count=None,
+                 search=None):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.descending = key.startswith('-')
+        self.key = key.lstrip('-')
+        self.tie_breaker = self.key not in UNIQUE_KEYSET_KEYS
+        self.search = search
+        self._count = count
+
+    @property
+    def count(self):
+        if callable(self._count):
+            self._count = self._count()
+        return self._count
+
+    @property
+    def num_pages(self):
+        count = self.count
+        if count is None:
+            return None
+        return max(1, int(math.ceil(count / float(self.per_page))))
+
+    def page(self, cursor=None):
+        position = self.decode_cursor(cursor)
+
+        backwards = False
+        queryset = self.queryset
+        if position:
+            backwards = position[0] == 'b'
+            queryset = queryset.filter(
+                self._get_filter(position[1:], backwards)
+            )
+
+        queryset = queryset.order_by(*self._get_ordering(backwards))
+        if self.search:
+            queryset = self.search(queryset)
+
+        items = list(queryset[:self.per_page + 1])
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+
+        if backwards:
+            items.reverse()
+            return KeysetPage(items, self, has_next=True,
+                              has_previous=has_more)
+
+        return KeysetPage(items, self, has_next=has_more,
+                          has_previous=bool(position))
+
+    def _get_ordering(self, backwards=False):
+        ret = [self.key]
+        if self.tie_breaker:
+            ret.append('pk')
+        if self.descending != backwards:
+            ret = ['-' + field for field in ret]
+        return ret
+
+    def _get_filter(self, values, backwards=False):
+        lookup = 'lt' if self.descending != backwards else 'gt'
+        ret = Q(**{'{}__{}'.format(self.key, lookup): values[0]})
+        if self.tie_breaker:
+            ret |= Q(**{
+                self.key: values[0], 'pk__{}'.format(lookup): values[1]
+            })
+        return ret
+
+    def get_position(self, item):
+        ret = [getattr(item, self.key)]
+        if self.tie_breaker:
+            ret.append(item.pk)
+        return ret
+
+    def encode_cursor(self, direction, item):
+        data = json.dumps(
+            [direction] + self.get_position(item), cls=DjangoJSONEncoder
+        )
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        '''
+        Returns [direction, key value(, pk)] or None if the cursor is
+        missing or invalid, in which case the first page is returned.
+        '''
+        if not cursor:
+            return None
+
+        try:
+            ret = json.loads(
+                base64.urlsafe_b64decode(str(cursor).encode('ascii'))
+            )
+        except (binascii.Error, UnicodeError, ValueError):
+            return None
+
+        size = 3 if self.tie_breaker else 2
+        if not isinstance(ret, list) or len(ret) != size or \
+                ret[0] not in ['a', 'b']:
+            return None
+
+        # the values are converted so that tampered ones can't break the
+        # filtering
+        values = []
+        for field, value in zip(self._get_position_fields(), ret[1:]):
+            try:
+                value = field.to_python(value)
+            except (ValidationError, ValueError, TypeError):
+                return None
+            if value is None:
+                return None
+            values.append(value)
+
+        return ret[:1] + values
+
+    def _get_position_fields(self):
+        '''
+        Returns the fields of the values of a position: the key, a model
+        field or an annotation, and the primary key to break ties.
+        '''
+        ret = [self.queryset.all().query.resolve_ref(self.key).output_field]
+        if self.tie_breaker:
+            ret.append(self.queryset.model._meta.pk)
+        return ret
+
+
+class KeysetPage(object):
+    '''
+    A page returned by `KeysetPaginator`. It has the same interface as a
+    django Page for iteration and previous/next navigation, with cursors
+    instead of page numbers.
+    '''
+
+    is_keyset = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<KeysetPage of {} items>'.format(len(self))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_cursor(self):
+        if not self.has_next():
+            return None
+        return self.paginator.encode_cursor('a', self.object_list[-1])
+
+    def previous_cursor(self):
+        if not self.has_previous() or not self.object_list:
+            return None
+        return self.paginator.encode_cursor('b', self.object_list[0])
+
+
+class PageTreeNode(object):
+    '''
+    A lightweight, cacheable, representation of a page in a tree of pages.
+    '''
+
+    def __init__(self, pk, title, url, depth):
+        self.pk = pk
+        self.title = title
+        self.url = url
+        self.depth = depth
+        self.children = []
+
+    def __repr__(self):
+        return '<PageTreeNode {}: {}>'.format(self.pk, self.title)
+
+
+def build_page_tree(root, request=None, max_depth=None, order_by='title'):
+    '''
+    Returns the tree of the live descendants of the `root` page as a list
+    of `PageTreeNode` (the root children) with one database query.
+
+    `max_depth` limits the number of levels below the root.
+    Siblings are sorted by the `order_by` attribute of the nodes.
+    Descendants of non-live pages are left out.
+    '''
+    from wagtail.core.models import Page
+
+    pages = Page.objects.live().descendant_of(root).order_by('path').only(
+        'title', 'path', 'depth', 'url_path'
+    )
+    if max_depth:
+        pages = pages.filter(depth__lte=root.depth + max_depth)
+
+    ret = []
+    nodes = {}
+    for page in pages.iterator():
+        node = PageTreeNode(
+            page.pk, page.title, page.get_url(request), page.depth
+        )
+        nodes[page.path] = node
+
+        if page.depth == root.depth + 1:
+            ret.append(node)
+        else:
+            parent = nodes.get(page.path[:-Page.steplen])
+            if parent:
+                parent.children.append(node)
+
+    if order_by:
+        def key(node):
+            return getattr(node, order_by)
+
+        ret.sort(key=key)
+        for node in nodes.values():
+            node.children.sort(key=key)
+
+    return ret
+
+
+def prefetch_images(objects, field_name='image'):
+    '''
+    Fetches the images referenced by the `field_name` foreign key of all the
+    `objects` in one query and caches them on the objects.
+    The objects can be of different types, those without the field are
+    ignored. Returns the list of images.
+    '''
+    from wagtail.images import get_image_model
+
+    attname = '{}_id'.format(field_name)
+    objects = [
+        obj for obj in objects if getattr(obj, attname, None) is not None
+    ]
+    if not objects:
+        return []
+
+    images = get_image_model().objects.in_bulk(
+        set(getattr(obj, attname) for obj in objects)
+    )
+    for obj in objects:
+        image = images.get(getattr(obj, attname))
+        if image:
+            setattr(obj, field_name, image)
+
+    return list(images.values())
+
+
+def prefetch_renditions(images, *filter_specs):
+    '''
+    Fetches the existing renditions of all the `images` for the given
+    `filter_specs` in one query. After this call image.get_rendition(spec)
+    (and therefore the {% image %} tag) returns them without querying the
+    database. Missing renditions are still generated on first use.
+    '''
+    from wagtail.images.models import Filter
+
+    images = [image for image in images if image is not None]
+    if not images or not filter_specs:
+        return images
+
+    Rendition = images[0].get_rendition_model()
+    renditions = {}
+    for rendition in Rendition.objects.filter(
+        image_id__in=set(image.pk for image in images),
+        filter_spec__in=filter_specs
+    ):
+        renditions[(
+            rendition.image_id, rendition.filter_spec,
+            rendition.focal_point_key
+        )] = rendition
+
+    filters = [Filter(spec=spec) for spec in filter_specs]
+    for image in images:
+        found = {}
+        for f in filters:
+            rendition = renditions.get(
+                (image.pk, f.spec, f.get_cache_key(image))
+            )
+            if rendition:
+                # avoids a query when accessing e.g. rendition.alt
+                rendition.image = image
+                found[f.spec] = rendition
+        _set_prefetched_renditions(image, found)
+
+    return images
+
+
+def _set_prefetched_renditions(image, renditions):
+    '''
+    Makes image.get_rendition() look up `renditions` (a dictionary
+    of renditions keyed by filter spec) before querying the database.
+    '''
+    prefetched = image.__dict__.get('_prefetched_renditions')
+    if prefetched is not None:
+        prefetched.update(renditions)
+        return
+
+    image._prefetched_renditions = dict(renditions)
+    get_rendition = image.get_rendition
+
+    def get_prefetched_rendition(filter):
+        spec = filter if isinstance(filter, str) else filter.spec
+        ret = image._prefetched_renditions.get(spec)
+        if ret is None:
+            ret = get_rendition(filter)
+            image._prefetched_renditions[spec] = ret
+        return ret
+
+    image.get_rendition = get_prefetched_rendition
+
+
+def migrate_wagtail_page_type(apps, schema_editor, mapping, batch_size=None,
+                              progress=None):
     '''
     Fairly generic method to convert all instances of one direct subtype
     of wagtail page into another.
@@ -50,6 +480,14 @@ def migrate_wagtail_page_type(apps, schema_editor, mapping):
     An OPTIONAL 'select' entry in 'mapping' links to a function that can
     further filter the default django queryset of all pages to convert.
 
+    For large numbers of pages, pass a `batch_size`: the pages are then
+    converted in batches of that size, with a constant number of queries
+    per batch, on any database backend. In that mode only the fields of
+    the new type table and the content_type are written, changes made by
+    the copy function to the fields of wagtailcore_page are ignored.
+    `progress` is an optional function called after each batch with the
+    number of converted pages and the total.
+
     IT IS RECOMMENDED TO BACK UP YOUR DATABASE BEFORE USING THIS FUNCTION.
 
     Example:
@@ -79,11 +517,6 @@ def migrate_wagtail_page_type(apps, schema_editor, mapping):
     PageFrom = apps.get_model(*mapping['models']['from'])
     PageTo = apps.get_model(*mapping['models']['to'])
 
-    # see ClusterableModel.to_json()
-    def to_json(page):
-        from wagtail.core.models import Page
-        return json.dumps(Page.serializable_data(page), cls=DjangoJSONEncoder)
-
     pages_to = []
 
     pages_from = PageFrom.objects.all()
@@ -111,35 +544,14 @@ def migrate_wagtail_page_type(apps, schema_editor, mapping):
         model=mapping['models']['to'][1].lower()
     ).first()
 
+    if batch_size:
+        return _migrate_wagtail_pages_in_batches(
+            pages_from, PageFrom, PageTo, PageRevision, content_type_to, copy,
+            batch_size, progress
+        )
+
     for page_from in pages_from:
-        page_to = PageTo()
-
-        # naive conversion: we copy all the fields which have a common name
-        # this will at least copy all the fields from Page table
-        # See wagtail.core.models.Page.copy()
-        for field in page_to._meta.get_fields():
-            # Ignore reverse relations
-            if field.auto_created:
-                continue
-
-            # Ignore m2m relations - they will be copied as child objects
-            # if modelcluster supports them at all (as it does for tags)
-            if field.many_to_many:
-                continue
-
-            if hasattr(page_from, field.name):
-                setattr(page_to, field.name, getattr(
-                    page_from, field.name, None
-                ))
-
-        # particular cases
-        page_to.id = page_from.id
-        page_to.page_ptr_id = page_from.page_ptr_id
-        page_to.content_type_id = content_type_to.pk
-
-        # custom copy
-        if copy:
-            copy(page_from, page_to)
+        page_to = _convert_page(page_from, PageTo, content_type_to, copy)
 
         pages_to.append(page_to)
 
@@ -148,21 +560,18 @@ def migrate_wagtail_page_type(apps, schema_editor, mapping):
             page_id=page_to.id
         ).order_by('-created_at', '-id').first()
         if page_rev:
-            page_rev.content_json = to_json(page_to)
+            page_rev.content_json = _page_to_json(page_to)
             page_rev.save()
 
     # Remove all the converted page
     # we use a raw statement instead of .delete() because we want to keep
     # the parent Page record.
-    # TODO: for large number of ids, we might need to process this in chunk.
-    # TODO: ANY in the the where clause may not work with other RDBMS than psql
-    from django.db import connection
-    with connection.cursor() as cursor:
-        cursor.execute(
-            'DELETE FROM {} WHERE page_ptr_id = ANY(%s)'.format(
-                PageFrom._meta.db_table),
-            [[p.page_ptr_id for p in pages_to]]
-        )
+    # For large number of pages use batch_size.
+    from django.db import connections
+    _delete_specific_rows(
+        connections[pages_from.db], PageFrom,
+        [p.page_ptr_id for p in pages_to]
+    )
 
     # now we can save the converted pages (without duplicate values)
     for page_to in pages_to:
@@ -171,17 +580,247 @@ def migrate_wagtail_page_type(apps, schema_editor, mapping):
     return len(pages_to)
 
 
+def _migrate_wagtail_pages_in_batches(pages_from, PageFrom, PageTo,
+                                      PageRevision, content_type_to, copy,
+                                      batch_size, progress=None):
+    '''
+    Converts `pages_from` into `PageTo` by batches of `batch_size` pages,
+    see `migrate_wagtail_page_type`.
+    '''
+    from django.db import connections
+    from django.db.models import OuterRef, Subquery
+
+    db = pages_from.db
+    connection = connections[db]
+    total = pages_from.count()
+    pages_from = pages_from.order_by('page_ptr_id')
+
+    # the fields of the PageTo table, including the pointer to Page
+    fields = PageTo._meta.local_concrete_fields
+    insert_batch_size = max(
+        1, connection.ops.bulk_batch_size(fields, [None] * batch_size)
+    )
+
+    latest_revisions = PageRevision.objects.filter(
+        page_id=OuterRef('page_id')
+    ).order_by('-created_at', '-id').values('id')[:1]
+
+    ret = 0
+    last_id = 0
+    while True:
+        batch = list(pages_from.filter(page_ptr_id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1].page_ptr_id
+
+        pages_to = dict(
+            (page_from.page_ptr_id, _convert_page(
+                page_from, PageTo, content_type_to, copy
+            ))
+            for page_from in batch
+        )
+        ids = list(pages_to.keys())
+
+        # convert the latest revision of each page, with a query per child
+        # relation serialised for the whole batch
+        revisions = list(PageRevision.objects.filter(
+            page_id__in=ids, id=Subquery(latest_revisions)
+        ))
+        _prefetch_child_relations(
+            [pages_to[revision.page_id] for revision in revisions], PageTo)
+        for revision in revisions:
+            revision.content_json = _page_to_json(pages_to[revision.page_id])
+        PageRevision.objects.bulk_update(revisions, ['content_json'])
+
+        # replace the records in the specific tables, but keep the Page ones
+        _delete_specific_rows(connection, PageFrom, ids)
+
+        # bulk_create() doesn't support multi-table inheritance, so we
+        # insert the rows of the PageTo table with the same method it uses
+        objs = list(pages_to.values())
+        for start in range(0, len(objs), insert_batch_size):
+            PageTo._base_manager.using(db)._insert(
+                objs[start:start + insert_batch_size], fields=fields
+            )
+
+        Page = PageTo._meta.get_field('page_ptr').related_model
+        Page._base_manager.using(db).filter(id__in=ids).update(
+            content_type_id=content_type_to.pk
+        )
+
+        ret += len(batch)
+        if progress:
+            progress(ret, total)
+
+    return ret
+
+
+def _convert_page(page_from, PageTo, content_type_to, copy=None):
+    page_to = PageTo()
+
+    # naive conversion: we copy all the fields which have a common name
+    # this will at least copy all the fields from Page table
+    # See wagtail.core.models.Page.copy()
+    for field in page_to._meta.get_fields():
+        # Ignore reverse relations
+        if field.auto_created:
+            continue
+
+        # Ignore m2m relations - they will be copied as child objects
+        # if modelcluster supports them at all (as it does for tags)
+        if field.many_to_many:
+            continue
+
+        # Ignore generic relations (e.g. search index entries), they are not
+        # part of historical models but exist on the current ones
+        if field.one_to_many:
+            continue
+
+        # the ids of the related objects rather than the objects, which
+        # would be fetched one page at a time
+        attname = getattr(field, 'attname', field.name)
+        if hasattr(page_from, attname):
+            setattr(page_to, attname, getattr(page_from, attname, None))
+
+    # particular cases
+    page_to.id = page_from.id
+    page_to.page_ptr_id = page_from.page_ptr_id
+    page_to.content_type_id = content_type_to.pk
+
+    # custom copy
+    if copy:
+        copy(page_from, page_to)
+
+    return page_to
+
+
+def _delete_specific_rows(connection, PageFrom, ids, chunk_size=500):
+    '''
+    Deletes the rows of the PageFrom table of the pages with `ids`, but not
+    their wagtailcore_page rows.
+    '''
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            cursor.execute(
+                'DELETE FROM {} WHERE page_ptr_id IN ({})'.format(
+                    connection.ops.quote_name(PageFrom._meta.db_table),
+                    ', '.join(['%s'] * len(chunk))
+                ),
+                chunk
+            )
+
+
+def _prefetch_child_relations(pages, PageTo):
+    '''
+    Fetches the child objects serialised by `_page_to_json` (e.g. the
+    comments) for all the `pages` at once.
+    '''
+    from modelcluster.models import (
+        get_all_child_m2m_relations, get_all_child_relations
+    )
+
+    lookups = [rel.get_accessor_name()
+               for rel in get_all_child_relations(PageTo)]
+    lookups += [field.name for field in get_all_child_m2m_relations(PageTo)
+                if field.serialize]
+    if pages and lookups:
+        prefetch_related_objects(pages, *lookups)
+
+
+def _page_to_json(page):
+    # see ClusterableModel.to_json()
+    from wagtail.core.models import Page
+    return json.dumps(Page.serializable_data(page), cls=DjangoJSONEncoder)
+
+
+# Krackdown: a minimal markup for rich text, see the krackdown template filter
+
+KRACKDOWN_ANCHOR_RE = re.compile(r'\{#([^\}]+)\}')
+KRACKDOWN_LINK_RE = re.compile(r'\[([^\[]+)\]\(([^\)]+)\)')
+KRACKDOWN_FOOTNOTE_RE = re.compile(r'\[\^([^\]]+)\]')
+
+# all the above in one pattern, see krackdown()
+KRACKDOWN_RE = re.compile(r'(?P<link>{})|(?P<footnote>{})|(?P<anchor>{})'.format(
+    r'\[(?P<link_text>[^\[]+)\]\((?P<link_url>[^\)]+)\)',
+    r'\[\^(?P<footnote_id>[^\]]+)\]',
+    r'\{#(?P<anchor_id>[^\}]+)\}',
+))
+
+KRACKDOWN_CACHE_SIZE = 1024
+
+
 def krackdown_anchor(html):
-    return re.sub(
-        r'\{#([^\}]+)\}', r'<a id="\1"></a>', html)
+    return KRACKDOWN_ANCHOR_RE.sub(r'<a id="\1"></a>', html)
 
 
 def krackdown_link(html):
-    return re.sub(
-        r'\[([^\[]+)\]\(([^\)]+)\)', r'<a href="\2">\1</a>', html)
+    return KRACKDOWN_LINK_RE.sub(r'<a href="\2">\1</a>', html)
 
 
 def krackdown_footnote(html):
-    return re.sub(
-        r'\[\^([^\]]+)\]',
+    return KRACKDOWN_FOOTNOTE_RE.sub(
         r'<sup id="fnref:\1"><a href="#fn:\1">\1</a></sup>', html)
+
+
+def krackdown(html):
+    '''
+    Applies krackdown_link, krackdown_footnote and krackdown_anchor in a
+    single pass over the html. The markup nested in a link, a footnote or
+    an anchor is converted as by the successive filters.
+
+    Unlike the successive filters, the output of a conversion isn't scanned
+    again, so malformed markup overlapping another one, e.g. '[^a{#b]}',
+    is converted once ('<sup id="fnref:a{#b">...</sup>}') rather than into
+    the broken HTML of the successive filters ('<sup id="fnref:a<a id="b">
+    ...</sup>"></a>').
+    '''
+    return KRACKDOWN_RE.sub(_krackdown_replace, html)
+
+
+def _krackdown_replace(match):
+    if match.group('link'):
+        # the footnotes and anchors are converted after the links
+        return '<a href="{}">{}</a>'.format(
+            krackdown_anchor(krackdown_footnote(match.group('link_url'))),
+            krackdown_anchor(krackdown_footnote(match.group('link_text')))
+        )
+
+    if match.group('footnote'):
+        return krackdown_anchor(
+            '<sup id="fnref:{0}"><a href="#fn:{0}">{0}</a></sup>'.format(
+                match.group('footnote_id'))
+        )
+
+    # the links and footnotes are converted before the anchors
+    return '<a id="{}"></a>'.format(
+        krackdown_footnote(krackdown_link(match.group('anchor_id'))))
+
+
+@functools.lru_cache(maxsize=None)
+def get_krackdown_filters():
+    '''
+    Returns the functions listed in the KDL_WAGTAIL_KRACKDOWN_FILTERS
+    setting, imported once.
+    '''
+    filters = getattr(settings, 'KDL_WAGTAIL_KRACKDOWN_FILTERS', [])
+
+    # not catching import errors to allow the propagation of the error
+    return [import_string(function_name) for function_name in filters]
+
+
+@functools.lru_cache(maxsize=KRACKDOWN_CACHE_SIZE)
+def apply_krackdown_filters(text):
+    '''
+    Applies the krackdown filters to the text. The results are memoised,
+    so the filters must only depend on their input.
+    '''
+    for f in get_krackdown_filters():
+        text = f(text)
+
+    return text
+
+
+def clear_krackdown_cache():
+    get_krackdown_filters.cache_clear()
+    apply_krackdown_filters.cache_clear()
@@ -1,3 +1,49 @@
-from django.shortcuts import render
+import os
 
-# Create your views here.
+from django.http import FileResponse, Http404, StreamingHttpResponse
+
+from . import sitemaps
+from .sites import get_site
+
+
+def sitemap_xml(request, sitemap_file='sitemap.xml'):
+    r'''
+    Serves the XML sitemap index or a section of the sitemap of the
+    current site.
+
+    Serves the file prebuilt by the `build_sitemaps` command if it exists,
+    otherwise streams it from the database. The sections are expected to be
+    served from the same path as the index, e.g.:
+
+    re_path(r'^(?P<sitemap_file>sitemap(-\d+)?\.xml)$', sitemap_xml)
+    '''
+    match = sitemaps.SITEMAP_FILE_RE.match(sitemap_file)
+    if not match:
+        raise Http404
+
+    site = get_site(request)
+    if not site:
+        raise Http404
+
+    path = os.path.join(sitemaps.get_sitemap_dir(site), sitemap_file)
+    if os.path.exists(path):
+        return FileResponse(open(path, 'rb'), content_type='application/xml')
+
+    pages = sitemaps.get_sitemap_pages(site)
+    section = match.group(1)
+    if section is None:
+        base_url = request.build_absolute_uri(
+            request.path.rsplit('/', 1)[0] + '/'
+        )
+        content = sitemaps.iter_sitemap_index_xml(
+            base_url, sitemaps.get_sitemap_sections(pages)
+        )
+    else:
+        section = int(section)
+        if not 0 < section <= sitemaps.get_sitemap_sections(pages):
+            raise Http404
+        content = sitemaps.iter_sitemap_xml(
+            sitemaps.get_sitemap_section_pages(pages, section), request
+        )
+
+    return StreamingHttpResponse(content, content_type='application/xml')
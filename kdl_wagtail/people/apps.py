@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class KdlWagtailPeopleConfig(AppConfig):
     name = 'kdl_wagtail.people'
     label = 'kdl_wagtail_people'
+
+    def ready(self):
+        self.register_signal_handlers()
+
+    def register_signal_handlers(self):
+        from .signal_handlers import register_signal_handlers
+        register_signal_handlers()
@@ -1,7 +1,10 @@
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models
+from django.db.models import Prefetch
+from django.utils.safestring import mark_safe
 from modelcluster.fields import ParentalKey
 from modelcluster.models import ClusterableModel
 from wagtail.admin.edit_handlers import (
@@ -13,12 +16,16 @@ from wagtail.admin.edit_handlers import (
 from wagtail.api import APIField
 from wagtail.core.fields import RichTextField
 from wagtail.core.models import Orderable
+from wagtail.images import get_image_model
 from wagtail.images.edit_handlers import ImageChooserPanel
+from wagtail.images.models import SourceImageIOError
 from wagtail.search import index
+from wagtail.search.backends import get_search_backends
 from wagtail.snippets.edit_handlers import SnippetChooserPanel
 from wagtail.snippets.models import register_snippet
 
 from kdl_wagtail.core.models import BaseIndexPage, BasePage
+from kdl_wagtail.core.utils import prefetch_renditions
 
 
 class BasePerson(index.Indexed, ClusterableModel):
@@ -35,6 +42,19 @@ class BasePerson(index.Indexed, ClusterableModel):
     https://github.com/wagtail/django-modelcluster
     """
 
+    # filter specs of the renditions of `image` used by the templates and the
+    # admin listing
+    image_rendition_specs = ["fill-180x180-c100", "fill-50x50"]
+
+    # filter spec of the thumbnail shown in the admin listing, the thumbnail
+    # img tag is cached per image
+    thumbnail_rendition_spec = "fill-50x50"
+    thumbnail_cache_timeout = 86400
+
+    # the names are suggested by the search pages, see
+    # kdl_wagtail.core.suggestions
+    search_suggestion_field = "name"
+
     _title = models.CharField("Title", max_length=254, blank=True, null=True)
     name = models.CharField("Name", max_length=254)
 
@@ -90,17 +110,97 @@ class BasePerson(index.Indexed, ClusterableModel):
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # generates the thumbnail now rather than in the admin listing
+        self.__dict__.pop("_thumbnail", None)
+        try:
+            self.thumbnail
+        except SourceImageIOError:
+            pass
+
     @property
     def thumbnail(self):
-        if self.image:
-            return self.image.get_rendition("fill-50x50").img_tag()
+        if not self.image_id:
+            return None
+
+        if "_thumbnail" not in self.__dict__:
+            key = self.get_thumbnail_cache_key(self.image_id)
+            ret = cache.get(key)
+            if ret is None:
+                ret = self.image.get_rendition(
+                    self.thumbnail_rendition_spec
+                ).img_tag()
+                cache.set(key, ret, self.thumbnail_cache_timeout)
+            self._thumbnail = mark_safe(ret)
+
+        return self._thumbnail
+
+    @classmethod
+    def get_thumbnail_cache_key(cls, image_id):
+        return "kdl_wagtail_person_thumbnail_{}_{}".format(
+            image_id, cls.thumbnail_rendition_spec
+        )
 
-        return None
+    @classmethod
+    def prefetch_thumbnails(cls, people):
+        """
+        Set the thumbnails of the `people` from the cache, the missing ones
+        are built from the images and renditions fetched in two queries.
+        Returns `people`.
+        """
+        by_key = {}
+        for person in people:
+            if person.image_id:
+                key = cls.get_thumbnail_cache_key(person.image_id)
+                by_key.setdefault(key, []).append(person)
+
+        thumbnails = cache.get_many(by_key.keys())
+
+        missing = [key for key in by_key if key not in thumbnails]
+        if missing:
+            images = get_image_model().objects.in_bulk(
+                [by_key[key][0].image_id for key in missing]
+            )
+            prefetch_renditions(images.values(), cls.thumbnail_rendition_spec)
+
+            built = {}
+            for key in missing:
+                image = images.get(by_key[key][0].image_id)
+                if image is None:
+                    continue
+                try:
+                    built[key] = image.get_rendition(
+                        cls.thumbnail_rendition_spec
+                    ).img_tag()
+                except SourceImageIOError:
+                    continue
+            cache.set_many(built, cls.thumbnail_cache_timeout)
+            thumbnails.update(built)
+
+        for key, group in by_key.items():
+            if key in thumbnails:
+                for person in group:
+                    person._thumbnail = mark_safe(thumbnails[key])
+
+        return people
 
     @property
     def title(self):
         return "{} {}".format(self._title if self._title else "", self.name).strip()
 
+    @property
+    def primary_page(self):
+        """
+        Return the first live page about the person, in tree order. Uses the
+        pages prefetched by `PeopleIndexPage.people` if available.
+        """
+        if hasattr(self, "live_pages"):
+            return self.live_pages[0] if self.live_pages else None
+
+        return self.pages.live().order_by("path").first()
+
 
 @register_snippet
 class Person(BasePerson):
@@ -171,15 +271,50 @@ class PeopleIndexPage(BaseIndexPage):
         )
     ]
 
+    # filter specs of the renditions of the people images in the listing
+    people_rendition_specs = ["fill-180x180-c100"]
+
+    @classmethod
+    def get_indexed_objects(cls):
+        # the people are indexed through the relationships, fetch them in bulk
+        # rather than with a query per relationship
+        return (
+            super()
+            .get_indexed_objects()
+            .prefetch_related("peopleindex_person_relationship__person")
+        )
+
     def people(self):
-        return self.peopleindex_person_relationship.all().select_related("person")
+        return (
+            self.peopleindex_person_relationship.all()
+            .select_related("person", "person__image")
+            .prefetch_related(
+                Prefetch(
+                    "person__pages",
+                    queryset=PersonPage.objects.live().order_by("path"),
+                    to_attr="live_pages",
+                )
+            )
+        )
 
     def get_context(self, request):
         context = super().get_context(request)
-        context["people"] = self.people()
+
+        people = list(self.people())
+        self.prefetch_people(people)
+        context["people"] = people
 
         return context
 
+    def prefetch_people(self, people):
+        """
+        Fetch in bulk the renditions of the images of the `people`
+        relationships.
+        """
+        prefetch_renditions(
+            [p.person.image for p in people], *self.people_rendition_specs
+        )
+
 
 class PersonPage(BasePage):
     person = models.ForeignKey(
@@ -193,3 +328,37 @@ class PersonPage(BasePage):
     search_fields = BasePage.search_fields + [
         index.RelatedFields("person", Person.search_fields)
     ]
+
+
+def update_people_pages_index(people, chunk_size=1000):
+    """
+    Update the search index of the pages which index data about the `people`
+    (objects or ids): their person pages and the people index pages listing
+    them. The pages are indexed in chunks of `chunk_size`, each fetched with
+    the related people by `get_indexed_objects`.
+    """
+    backends = list(get_search_backends(with_auto_update=True))
+    if not backends:
+        return
+
+    person_ids = [getattr(person, "pk", person) for person in people]
+
+    for model, lookup in [
+        (PersonPage, "person__in"),
+        (PeopleIndexPage, "peopleindex_person_relationship__person__in"),
+    ]:
+        page_ids = sorted(
+            set(
+                model.get_indexed_objects()
+                .filter(**{lookup: person_ids})
+                .values_list("pk", flat=True)
+            )
+        )
+        for start in range(0, len(page_ids), chunk_size):
+            pages = list(
+                model.get_indexed_objects().filter(
+                    pk__in=page_ids[start:start + chunk_size]
+                )
+            )
+            for backend in backends:
+                backend.add_bulk(model, pages)
@@ -0,0 +1,29 @@
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from wagtail.images import get_image_model
+
+
+def update_person_pages_index(sender, instance, **kwargs):
+    from .models import update_people_pages_index
+    update_people_pages_index([instance])
+
+
+def invalidate_person_thumbnail(sender, instance, **kwargs):
+    from .models import PersonModel
+    cache.delete(PersonModel.get_thumbnail_cache_key(instance.pk))
+
+
+def register_signal_handlers():
+    from .models import PersonModel
+
+    post_save.connect(
+        update_person_pages_index, sender=PersonModel,
+        dispatch_uid='kdl_wagtail_people_pages_index')
+
+    image_model = get_image_model()
+    post_save.connect(
+        invalidate_person_thumbnail, sender=image_model,
+        dispatch_uid='kdl_wagtail_person_thumbnail_saved')
+    post_delete.connect(
+        invalidate_person_thumbnail, sender=image_model,
+        dispatch_uid='kdl_wagtail_person_thumbnail_deleted')
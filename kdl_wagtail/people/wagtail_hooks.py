@@ -1,10 +1,21 @@
 from wagtail.contrib.modeladmin.options import ModelAdmin, modeladmin_register
+from wagtail.contrib.modeladmin.views import IndexView
 
 from .models import get_person_model
 
 
+class PersonIndexView(IndexView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["object_list"] = self.model.prefetch_thumbnails(
+            list(context["object_list"])
+        )
+        return context
+
+
 class PersonModelAdmin(ModelAdmin):
     model = get_person_model()
+    index_view_class = PersonIndexView
     list_display = ['name', 'title', 'thumbnail']
     menu_icon = 'group'
 
@@ -1,94 +1,395 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from pyzotero import zotero
+from django.db import transaction
+from wagtail.search.backends import get_search_backends
+
+from kdl_wagtail.zotero.models import Bibliography, ZoteroSync, get_author_initial
+
+# fields written by the import, besides the key
+IMPORT_FIELDS = [
+    "item_type",
+    "author",
+    "author_initial",
+    "order",
+    "citation",
+    "citation_short",
+    "url",
+    "bib",
+    "bib_html",
+    "citation_html",
+    "citation_short_html",
+]
 
-from kdl_wagtail.zotero.models import Bibliography
+# maximum number of items per request allowed by the Zotero API
+PAGE_SIZE = 100
 
 
 class Command(BaseCommand):
     help = "Imports bibliography records from Zotero"
 
+    retries = 3
+    # seconds before retrying a failed request, doubled after each attempt
+    retry_delay = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = threading.local()
+
     def add_arguments(self, parser):
         parser.add_argument(
             "--delete",
             action="store_true",
             help="Delete existing bibliography entries before doing an import",
         )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the number of entries --delete would delete",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of bibliography entries written per query",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only import the items modified since the last import",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of concurrent requests to the Zotero API",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=3,
+            help="Number of times a failed request to the Zotero API is retried",
+        )
 
     def handle(self, *args, **options):
         try:
-            zot = zotero.Zotero(
-                settings.KDL_WAGTAIL_ZOTERO_LIBRARY_ID,
-                settings.KDL_WAGTAIL_ZOTERO_LIBRARY_TYPE,
-                settings.KDL_WAGTAIL_ZOTERO_TOKEN,
-                preserve_json_order=True,
-            )
+            self.retries = options["retries"]
+            zot = self.get_client()
             collection_id = settings.KDL_WAGTAIL_ZOTERO_COLLECTION
             citation_styles = {
                 "note": settings.KDL_WAGTAIL_ZOTERO_NOTE_STYLE,
                 "shortnote": settings.KDL_WAGTAIL_ZOTERO_SHORTNOTE_STYLE,
             }
 
-            if options["delete"]:
-                self.delete_bibliography()
+            if options["delete"] or options["dry_run"]:
+                self.delete_bibliography(options["batch_size"], options["dry_run"])
+                if options["dry_run"]:
+                    return
                 self.stdout.write("")
 
-            self.import_bibliography(zot, collection_id, citation_styles)
+            self.import_bibliography(
+                zot,
+                collection_id,
+                citation_styles,
+                options["batch_size"],
+                options["incremental"],
+                options["workers"],
+            )
         except AttributeError as e:
             raise CommandError(e)
 
-    def delete_bibliography(self):
+    def get_client(self):
+        from pyzotero import zotero
+
+        return zotero.Zotero(
+            settings.KDL_WAGTAIL_ZOTERO_LIBRARY_ID,
+            settings.KDL_WAGTAIL_ZOTERO_LIBRARY_TYPE,
+            settings.KDL_WAGTAIL_ZOTERO_TOKEN,
+            preserve_json_order=True,
+        )
+
+    def get_thread_client(self):
+        # the pyzotero client keeps the parameters of the current request,
+        # so it can't be shared between threads
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.get_client()
+        return client
+
+    def retry(self, func, *args, **kwargs):
+        """
+        Calls `func`, retrying up to `self.retries` times with an exponential
+        backoff if it fails.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                self.stderr.write(
+                    "Zotero request failed ({}), retrying in {}s".format(e, delay)
+                )
+                time.sleep(delay)
+
+    def delete_bibliography(self, batch_size=500, dry_run=False):
         number_of_entries = Bibliography.objects.count()
         if number_of_entries == 0:
             self.stdout.write(self.style.NOTICE("No bibliography entries to delete"))
             return
 
+        unused = set(Bibliography.objects.values_list("pk", flat=True))
+        unused -= Bibliography.get_used_ids()
+
+        if dry_run:
+            self.stdout.write(
+                "{} of {} bibliography entries are not being used and would be "
+                "deleted".format(len(unused), number_of_entries)
+            )
+            return
+
         self.stdout.write(
             self.style.WARNING("Deleting bibliography entries that are not being used")
         )
 
-        for b in Bibliography.objects.all():
-            if not b.get_usage():
-                b.delete()
+        self.delete_entries(unused, batch_size)
+        Bibliography.invalidate_cache()
+        self.stdout.write(
+            "{} of {} bibliography entries deleted".format(
+                len(unused), number_of_entries
+            )
+        )
+
+    @transaction.atomic
+    def delete_entries(self, ids, batch_size):
+        ids = sorted(ids)
+        for start in range(0, len(ids), batch_size):
+            Bibliography.objects.filter(pk__in=ids[start:start + batch_size]).delete()
+
+    def import_bibliography(
+        self,
+        zot,
+        collection_id,
+        citation_styles,
+        batch_size=500,
+        incremental=False,
+        workers=1,
+    ):
+        since = None
+        if incremental:
+            since = ZoteroSync.get_version(collection_id)
+        if since is None:
+            self.stdout.write("Importing bibliography entries from Zotero")
+        else:
+            self.stdout.write(
+                "Importing bibliography entries modified in Zotero since "
+                "version {}".format(since)
+            )
+
+        start = time.time()
+        # read before fetching the items, so the changes made during the
+        # import are fetched again by the next one
+        version = self.retry(zot.last_modified_version)
+        keys = self.retry(self.fetch_keys, zot, collection_id)
+        entries = self.fetch_entries(
+            zot, collection_id, citation_styles, keys, since, workers
+        )
+        fetched = time.time()
+        self.stdout.write(
+            "{} items fetched in {:.1f}s".format(len(entries), fetched - start)
+        )
 
-    def import_bibliography(self, zot, collection_id, citation_styles):
-        self.stdout.write("Importing bibliography entries from Zotero")
+        created, updated = self.save_entries(entries, batch_size)
+        if since is not None:
+            self.sync_entries(keys, batch_size)
 
+        ZoteroSync.set_version(collection_id, version)
+        Bibliography.invalidate_cache()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "{} bibliography entries imported ({} created, {} updated) "
+                "in {:.1f}s".format(
+                    created + updated, created, updated, time.time() - fetched
+                )
+            )
+        )
+
+    def fetch_entries(
+        self, zot, collection_id, citation_styles, keys, since=None, workers=1
+    ):
+        """
+        Returns the field values of the Zotero items in all the citation
+        styles, keyed by Zotero key. Only the items modified after the
+        library version `since` are fetched, if given.
+
+        `keys` maps the keys of the collection to their position. The pages
+        of items are fetched by `workers` threads, except with `since` as
+        the number of modified items isn't known in advance.
+        """
+        jobs = []
         for key in citation_styles.keys():
-            citation_style = citation_styles[key]
+            if since is None:
+                jobs.extend(
+                    (collection_id, key, citation_styles[key], start, None)
+                    for start in range(0, len(keys), PAGE_SIZE)
+                )
+            else:
+                jobs.append((collection_id, key, citation_styles[key], None, since))
+
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                pages = list(executor.map(self.fetch_items, jobs))
+        else:
+            pages = [self.fetch_items(job, zot) for job in jobs]
+
+        entries = {}
 
-            for idx, item in self.items_enumerator(zot, collection_id, citation_style):
-                b, _ = Bibliography.objects.get_or_create(key=item["key"])
+        for (_, key, _, start, _), items in zip(jobs, pages):
+            for idx, item in enumerate(items, start or 0):
+                entry = entries.setdefault(item["key"], {})
 
-                b.item_type = item["data"]["itemType"]
+                entry["item_type"] = item["data"]["itemType"]
 
                 if "creatorSummary" in item["meta"]:
-                    b.author = item["meta"]["creatorSummary"]
+                    entry["author"] = item["meta"]["creatorSummary"]
 
-                b.order = idx
+                entry["order"] = keys.get(item["key"], idx)
 
                 if key == "shortnote":
-                    b.citation_short = item["citation"]
+                    entry["citation_short"] = item["citation"]
                 else:
-                    b.citation = item["citation"]
+                    entry["citation"] = item["citation"]
 
-                b.url = item["links"]["alternate"]["href"]
-                b.bib = item["bib"]
-                b.save()
+                entry["url"] = item["links"]["alternate"]["href"]
+                entry["bib"] = item["bib"]
 
-        self.stdout.write(
-            self.style.SUCCESS("{} bibliography entries imported".format(idx))
-        )
-
-    def items_enumerator(self, zot, collection_id, citation_style):
-        return enumerate(
-            zot.everything(
-                zot.collection_items(
-                    collection_id,
-                    include="bib,citation,data",
-                    itemType="-attachment",
-                    order="creator",
-                    style=citation_style,
+        return entries
+
+    @transaction.atomic
+    def save_entries(self, entries, batch_size):
+        """
+        Creates or updates the bibliography `entries` with a few queries per
+        batch of `batch_size` entries. Returns the number of entries created
+        and updated.
+        """
+        created = updated = 0
+
+        keys = list(entries.keys())
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            existing = Bibliography.objects.in_bulk(batch, field_name="key")
+
+            to_create = []
+            to_update = []
+            for key in batch:
+                b = existing.get(key)
+                if b is None:
+                    b = Bibliography(key=key)
+                    to_create.append(b)
+                else:
+                    to_update.append(b)
+
+                for name, value in entries[key].items():
+                    setattr(b, name, value)
+                # bulk queries don't call save()
+                b.author_initial = get_author_initial(b.author)
+                b.render_html()
+
+            Bibliography.objects.bulk_create(to_create, batch_size=batch_size)
+            Bibliography.objects.bulk_update(
+                to_update, IMPORT_FIELDS, batch_size=batch_size
+            )
+
+            # nor do they send the signals updating the search index
+            for backend in get_search_backends(with_auto_update=True):
+                backend.add_bulk(
+                    Bibliography, Bibliography.objects.filter(key__in=batch)
                 )
+
+            created += len(to_create)
+            updated += len(to_update)
+
+        return created, updated
+
+    def fetch_keys(self, zot, collection_id):
+        """
+        Returns the position of all the items of the collection, keyed by
+        Zotero key, in a single request.
+        """
+        keys = zot.collection_items(
+            collection_id, format="keys", itemType="-attachment", order="creator"
+        )
+        if isinstance(keys, bytes):
+            keys = keys.decode("utf-8")
+
+        return {key: idx for idx, key in enumerate(keys.split())}
+
+    @transaction.atomic
+    def sync_entries(self, keys, batch_size):
+        """
+        Updates the order of the entries which moved in the collection and
+        deletes the unused entries which are no longer in it. `keys` maps
+        the Zotero keys of the collection to their position.
+        """
+        moved = []
+        removed = {}
+        for pk, key, order in Bibliography.objects.values_list("pk", "key", "order"):
+            if key not in keys:
+                removed[pk] = key
+            elif keys[key] != order:
+                moved.append(Bibliography(pk=pk, order=keys[key]))
+
+        Bibliography.objects.bulk_update(moved, ["order"], batch_size=batch_size)
+
+        if removed:
+            for pk in Bibliography.get_used_ids() & set(removed):
+                self.stdout.write(
+                    self.style.WARNING(
+                        "{} was removed from Zotero but is still used".format(
+                            removed.pop(pk)
+                        )
+                    )
+                )
+            self.delete_entries(removed.keys(), batch_size)
+
+        self.stdout.write(
+            "{} bibliography entries reordered, {} deleted".format(
+                len(moved), len(removed)
+            )
+        )
+
+    def fetch_items(self, job, zot=None):
+        """
+        Returns the items of a page of the collection in a citation style,
+        or all the items modified since a library version if the page
+        `start` is None.
+        """
+        collection_id, _, citation_style, start, since = job
+        zot = zot or self.get_thread_client()
+
+        kwargs = dict(
+            include="bib,citation,data",
+            itemType="-attachment",
+            order="creator",
+            style=citation_style,
+        )
+
+        if start is not None:
+            return self.retry(
+                zot.collection_items,
+                collection_id,
+                start=start,
+                limit=PAGE_SIZE,
+                **kwargs
+            )
+
+        return self.retry(
+            lambda: zot.everything(
+                zot.collection_items(collection_id, since=since, **kwargs)
             )
         )
@@ -0,0 +1,89 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:14
+
+import re
+
+from django.db import migrations, models
+from wagtail.core.rich_text import expand_db_html
+from wagtail.core.whitelist import (
+    DEFAULT_ELEMENT_RULES, Whitelister, attribute_rule
+)
+
+# frozen copy of kdl_wagtail.zotero.models.render_bibliography_html, so
+# that later changes to the models don't change this migration
+
+CSL_STYLE_PROPERTIES = {
+    'display', 'font-style', 'font-variant', 'font-weight', 'line-height',
+    'margin-left', 'padding-left', 'text-decoration', 'text-indent',
+    'vertical-align',
+}
+CSL_STYLE_VALUE_RE = re.compile(r'^[\w\s.,%#-]+$')
+
+
+def clean_csl_style(value):
+    declarations = []
+    for declaration in value.split(';'):
+        prop, _, prop_value = declaration.partition(':')
+        prop, prop_value = prop.strip().lower(), prop_value.strip()
+        if prop not in CSL_STYLE_PROPERTIES:
+            continue
+        if CSL_STYLE_VALUE_RE.match(prop_value):
+            declarations.append('{}: {}'.format(prop, prop_value))
+
+    return '; '.join(declarations) or None
+
+
+class BibliographyWhitelister(Whitelister):
+    element_rules = dict(
+        DEFAULT_ELEMENT_RULES,
+        div=attribute_rule({'class': True, 'style': clean_csl_style}),
+        span=attribute_rule({'class': True, 'style': clean_csl_style}),
+    )
+
+
+def render_bibliography_html(value):
+    if not value:
+        return ''
+
+    return BibliographyWhitelister().clean(expand_db_html(value))
+
+
+def render_html(apps, schema_editor):
+    Bibliography = apps.get_model('kdl_wagtail_zotero', 'Bibliography')
+
+    entries = []
+    for b in Bibliography.objects.iterator():
+        b.bib_html = render_bibliography_html(b.bib)
+        b.citation_html = render_bibliography_html(b.citation)
+        b.citation_short_html = render_bibliography_html(b.citation_short)
+        entries.append(b)
+
+    Bibliography.objects.bulk_update(
+        entries, ['bib_html', 'citation_html', 'citation_short_html'],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdl_wagtail_zotero', '0009_bibliography_item_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bibliography',
+            name='bib_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='bibliography',
+            name='citation_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='bibliography',
+            name='citation_short_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(render_html, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdl_wagtail_zotero', '0010_bibliography_html'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZoteroSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(max_length=32, unique=True)),
+                ('version', models.PositiveIntegerField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:04
+
+from django.db import migrations, models
+
+
+def set_author_initial(apps, schema_editor):
+    Bibliography = apps.get_model('kdl_wagtail_zotero', 'Bibliography')
+
+    entries = []
+    for b in Bibliography.objects.only('author').iterator():
+        b.author_initial = (b.author or '').strip()[:1].upper()
+        entries.append(b)
+
+    Bibliography.objects.bulk_update(
+        entries, ['author_initial'], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdl_wagtail_zotero', '0011_zoterosync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bibliography',
+            name='author_initial',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=1),
+        ),
+        migrations.RunPython(set_author_initial, migrations.RunPython.noop),
+    ]
@@ -1,27 +1,108 @@
+import json
+import operator
+import re
+from functools import reduce
+
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import Q, Value
+from django.db.models.functions import Cast, Coalesce
 from django.utils.safestring import mark_safe
 from kdl_wagtail.core.models import BaseIndexPage
+from kdl_wagtail.core.utils import CURSOR_PARAM, paginate, paginate_keyset
+from modelcluster.fields import ParentalKey
 from modelcluster.models import ClusterableModel
 from wagtail.admin.edit_handlers import FieldPanel
 from wagtail.api import APIField
-from wagtail.core.fields import RichTextField
+from wagtail.core.blocks import StreamValue
+from wagtail.core.fields import RichTextField, StreamField
+from wagtail.core.models import Page
+from wagtail.core.rich_text import RichText, expand_db_html
+from wagtail.core.whitelist import (
+    DEFAULT_ELEMENT_RULES, Whitelister, attribute_rule
+)
 from wagtail.search import index
+from wagtail.search.backends import get_search_backend
 from wagtail.snippets.models import register_snippet
 
 
+# the CSS properties set by the Zotero citation styles (CSL)
+CSL_STYLE_PROPERTIES = {
+    'display', 'font-style', 'font-variant', 'font-weight', 'line-height',
+    'margin-left', 'padding-left', 'text-decoration', 'text-indent',
+    'vertical-align',
+}
+CSL_STYLE_VALUE_RE = re.compile(r'^[\w\s.,%#-]+$')
+
+
+def clean_csl_style(value):
+    """
+    Returns the declarations of the `style` attribute `value` which set
+    the `CSL_STYLE_PROPERTIES` to plain values (e.g. not `url()`), or None.
+    """
+    declarations = []
+    for declaration in value.split(';'):
+        prop, _, prop_value = declaration.partition(':')
+        prop, prop_value = prop.strip().lower(), prop_value.strip()
+        if prop not in CSL_STYLE_PROPERTIES:
+            continue
+        if CSL_STYLE_VALUE_RE.match(prop_value):
+            declarations.append('{}: {}'.format(prop, prop_value))
+
+    return '; '.join(declarations) or None
+
+
+class BibliographyWhitelister(Whitelister):
+    """
+    Keeps the markup of the Zotero citation styles (csl-* classes and the
+    CSL formatting styles) and drops anything else that isn't allowed in
+    rich text.
+    """
+    element_rules = dict(
+        DEFAULT_ELEMENT_RULES,
+        div=attribute_rule({'class': True, 'style': clean_csl_style}),
+        span=attribute_rule({'class': True, 'style': clean_csl_style}),
+    )
+
+
+def get_author_initial(author):
+    """Returns the upper case initial of `author`, '' if there is none."""
+    return (author or '').strip()[:1].upper()
+
+
+def render_bibliography_html(value):
+    """
+    Returns the rich text `value` with its links expanded and its HTML
+    sanitised, ready to be output as is.
+    """
+    if not value:
+        return ''
+
+    return BibliographyWhitelister().clean(expand_db_html(value))
+
+
 class BaseBibliography(index.Indexed, ClusterableModel):
     key = models.CharField(max_length=32, unique=True)
     item_type = models.CharField(max_length=64)
     author = models.CharField(max_length=256, null=True)
+    # filters the entries by initial, set on save from the author
+    author_initial = models.CharField(
+        max_length=1, blank=True, editable=False, db_index=True)
     order = models.PositiveSmallIntegerField(null=True)
     citation = RichTextField(verbose_name='note')
     citation_short = RichTextField(null=True, verbose_name='shortnote')
     url = models.URLField()
     bib = RichTextField(verbose_name='bibliography entry')
 
+    # sanitised HTML of the rich text fields, rendered on save
+    bib_html = models.TextField(blank=True, editable=False)
+    citation_html = models.TextField(blank=True, editable=False)
+    citation_short_html = models.TextField(blank=True, editable=False)
+
     api_fields = [
         APIField('key'),
         APIField('item_type'),
@@ -47,9 +128,21 @@ class BaseBibliography(index.Indexed, ClusterableModel):
         index.SearchField('author'),
         index.SearchField('citation'),
         index.SearchField('citation_short'),
-        index.SearchField('bib')
+        index.SearchField('bib'),
+        index.FilterField('item_type'),
+        index.FilterField('author'),
+        index.FilterField('author_initial'),
+        index.FilterField('order')
     ]
 
+    # entries cited in rich text link to their zotero.org page
+    CITATION_RE = re.compile(
+        r'zotero\.org/(?:(?:users|groups)/)?[^/\s"]+/items/(?:itemKey/)?'
+        r'([A-Z0-9]{8})'
+    )
+    CACHE_VERSION_KEY = 'kdl_wagtail_bibliography_version'
+    cache_timeout = 86400
+
     class Meta:
         abstract = True
         ordering = ['order']
@@ -59,17 +152,176 @@ class BaseBibliography(index.Indexed, ClusterableModel):
     def __str__(self):
         return mark_safe(self.entry)
 
+    def save(self, *args, **kwargs):
+        self.author_initial = get_author_initial(self.author)
+        self.render_html()
+        super().save(*args, **kwargs)
+        cache.delete(self.get_cache_key(self.key))
+
+    def delete(self, *args, **kwargs):
+        cache.delete(self.get_cache_key(self.key))
+        return super().delete(*args, **kwargs)
+
+    def render_html(self):
+        """
+        Renders the `*_html` fields from the rich text fields, so they can be
+        output without going through the `richtext` filter.
+        """
+        self.bib_html = render_bibliography_html(self.bib)
+        self.citation_html = render_bibliography_html(self.citation)
+        self.citation_short_html = render_bibliography_html(
+            self.citation_short)
+
+    @classmethod
+    def get_used_ids(cls):
+        """
+        Returns the set of ids of the entries used by pages, i.e. the entries
+        with a non empty `get_usage()`, with a query per relation, and the
+        entries cited in rich text, see `get_cited_ids`.
+        """
+        ret = set()
+
+        relations = [
+            f for f in cls._meta.get_fields(include_hidden=True)
+            if (f.one_to_many or f.one_to_one) and f.auto_created
+        ]
+        for relation in relations:
+            related_model = relation.related_model
+            used = related_model._base_manager.exclude(
+                **{relation.field.attname: None})
+
+            if not issubclass(related_model, Page):
+                # only the relations through a page count as a usage
+                page_keys = [
+                    f for f in related_model._meta.fields
+                    if isinstance(f, ParentalKey) and issubclass(
+                        f.remote_field.model, Page)
+                ]
+                if not page_keys:
+                    continue
+                used = used.filter(reduce(operator.or_, [
+                    Q(**{'{}__isnull'.format(f.name): False})
+                    for f in page_keys
+                ]))
+
+            ret.update(
+                used.values_list(relation.field.attname, flat=True).distinct())
+
+        ret.update(cls.get_cited_ids())
+
+        return ret
+
+    @classmethod
+    def get_cited_ids(cls, batch_size=500):
+        """
+        Returns the set of ids of the entries cited by a zotero.org link in
+        the rich text and stream fields of any model, see `get_cited_keys`,
+        with a query per field and per batch of `batch_size` keys.
+        """
+        keys = set()
+        for model in apps.get_models():
+            if issubclass(model, BaseBibliography):
+                continue
+            for field in model._meta.local_concrete_fields:
+                if not isinstance(field, (RichTextField, StreamField)):
+                    continue
+                # only the values with a link, read as text
+                values = model._base_manager.annotate(
+                    cited_text=Cast(field.attname, models.TextField())
+                ).filter(cited_text__contains='zotero.org').values_list(
+                    'cited_text', flat=True)
+                for value in values.iterator():
+                    keys.update(cls.get_cited_keys(value))
+
+        ret = set()
+        keys = sorted(keys)
+        for start in range(0, len(keys), batch_size):
+            ret.update(cls.objects.filter(
+                key__in=keys[start:start + batch_size]
+            ).values_list('pk', flat=True))
+
+        return ret
+
+    @classmethod
+    def get_cited_keys(cls, value):
+        """
+        Returns the keys of the entries cited in `value`, a rich text, a
+        stream field value or a list of them, in order of first citation.
+        """
+        if isinstance(value, StreamValue):
+            value = json.dumps(value.get_prep_value(), cls=DjangoJSONEncoder)
+        elif isinstance(value, RichText):
+            value = value.source
+        elif isinstance(value, (list, tuple)):
+            ret = []
+            for v in value:
+                ret.extend(cls.get_cited_keys(v))
+            return list(dict.fromkeys(ret))
+
+        return list(dict.fromkeys(cls.CITATION_RE.findall(value or '')))
+
+    @classmethod
+    def resolve_keys(cls, keys):
+        """
+        Returns a dictionary of the entries with the given `keys`, keyed by
+        key. The entries are cached per key and the ones missing from the
+        cache are fetched in a single query.
+        """
+        version = cache.get(cls.CACHE_VERSION_KEY, 0)
+        cache_keys = {cls.get_cache_key(key, version): key for key in keys}
+        cached = cache.get_many(cache_keys.keys())
+
+        ret = {
+            cache_keys[cache_key]: entry
+            for cache_key, entry in cached.items()
+        }
+
+        missing = [key for key in keys if key not in ret]
+        if missing:
+            fetched = cls.objects.in_bulk(missing, field_name='key')
+            # unknown keys are cached too, as False
+            cache.set_many({
+                cls.get_cache_key(key, version): fetched.get(key, False)
+                for key in missing
+            }, cls.cache_timeout)
+            ret.update(fetched)
+
+        return {key: entry for key, entry in ret.items() if entry}
+
+    @classmethod
+    def resolve(cls, value):
+        """
+        Returns the list of entries cited in `value`, see `get_cited_keys`.
+        """
+        keys = cls.get_cited_keys(value)
+        entries = cls.resolve_keys(keys)
+        return [entries[key] for key in keys if key in entries]
+
+    @classmethod
+    def get_cache_key(cls, key, version=None):
+        if version is None:
+            version = cache.get(cls.CACHE_VERSION_KEY, 0)
+        return 'kdl_wagtail_bibliography_{}_{}_{}'.format(
+            version, cls._meta.label_lower, key)
+
+    @classmethod
+    def invalidate_cache(cls):
+        try:
+            cache.incr(cls.CACHE_VERSION_KEY)
+        except ValueError:
+            cache.set(cls.CACHE_VERSION_KEY, 1, None)
+
     @property
     def entry(self):
-        return mark_safe(self.bib)
+        return mark_safe(self.bib_html or self.bib)
 
     @property
     def note(self):
-        return mark_safe(self.citation)
+        return mark_safe(self.citation_html or self.citation)
 
     @property
     def shortnote(self):
-        return mark_safe(self.citation_short)
+        return mark_safe(self.citation_short_html or self.citation_short)
 
 
 @register_snippet
@@ -77,6 +329,29 @@ class Bibliography(BaseBibliography):
     pass
 
 
+class ZoteroSync(models.Model):
+    """
+    The Zotero library version of the last import of a collection, the
+    incremental imports only fetch the items modified since that version.
+    """
+    collection = models.CharField(max_length=32, unique=True)
+    version = models.PositiveIntegerField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{} ({})'.format(self.collection, self.version)
+
+    @classmethod
+    def get_version(cls, collection):
+        return cls.objects.filter(collection=collection).values_list(
+            'version', flat=True).first()
+
+    @classmethod
+    def set_version(cls, collection, version):
+        cls.objects.update_or_create(
+            collection=collection, defaults={'version': version})
+
+
 def get_bibliography_model():
     """
     Return the bibliography model that is active in this project. Defaults to
@@ -105,12 +380,70 @@ def get_bibliography_model():
 BibliographyModel = get_bibliography_model()
 
 
+# sort order of the entries without an order, after the values of the
+# PositiveSmallIntegerField
+UNORDERED = 2 ** 15
+
+
 class BibliographyIndexPage(BaseIndexPage):
+    '''
+    Lists the bibliography entries, paginated and filtered with the query
+    string parameters `q` (search phrase), `item_type` and `author` (the
+    initial of the author).
+
+    The entries are paginated with a cursor on `entries_pagination_keyset`,
+    or by page number when they are searched, as they are then ordered by
+    relevance. The cursor key can't be null, the entries are annotated with
+    their `sort_order`, the `order` of the entries with one, followed by
+    the others.
+    '''
+    entries_pagination_keyset = 'sort_order'
+
     def entries(self):
         return BibliographyModel.objects.all()
 
     def get_context(self, request):
         context = super().get_context(request)
-        context['entries'] = self.entries()
+
+        filters = self.get_entries_filters(request)
+        context['entries'] = self._paginate_entries(request, filters)
+        context['entries_filters'] = filters
+        context['item_types'] = BibliographyModel.objects.exclude(
+            item_type=''
+        ).order_by('item_type').values_list('item_type', flat=True).distinct()
 
         return context
+
+    def get_entries_filters(self, request):
+        return {
+            'q': request.GET.get('q', '').strip(),
+            'item_type': request.GET.get('item_type', '').strip(),
+            'author': request.GET.get('author', '').strip()[:1],
+        }
+
+    def filter_entries(self, entries, filters):
+        if filters['item_type']:
+            entries = entries.filter(item_type=filters['item_type'])
+        if filters['author']:
+            # an exact filter, unlike istartswith, is supported by all the
+            # search backends
+            entries = entries.filter(
+                author_initial=get_author_initial(filters['author']))
+        return entries
+
+    def _paginate_entries(self, request, filters):
+        entries = self.filter_entries(self.entries(), filters)
+
+        if filters['q']:
+            return paginate(
+                get_search_backend().search(filters['q'], entries),
+                request.GET.get('page')
+            )
+
+        entries = entries.annotate(sort_order=Coalesce(
+            'order', Value(UNORDERED, output_field=models.IntegerField())
+        ))
+        return paginate_keyset(
+            entries, request.GET.get(CURSOR_PARAM),
+            key=self.entries_pagination_keyset, count=entries.count
+        )
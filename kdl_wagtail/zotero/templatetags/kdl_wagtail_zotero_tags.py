@@ -0,0 +1,15 @@
+from django import template
+
+from kdl_wagtail.zotero.models import get_bibliography_model
+
+register = template.Library()
+
+
+@register.simple_tag
+def get_bibliography(value):
+    """Return the bibliography entries cited in a rich text or stream field,
+    in order of citation, with a single query at most.
+
+    {% get_bibliography page.body as bibliography %}
+    """
+    return get_bibliography_model().resolve(value)
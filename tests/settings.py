@@ -38,6 +38,7 @@ INSTALLED_APPS = [
 
     'kdl_wagtail.core.apps.KdlWagtailCoreConfig',
     'kdl_wagtail.people.apps.KdlWagtailPeopleConfig',
+    'kdl_wagtail.zotero.apps.KdlWagtailZoteroConfig',
 ]
 
 SITE_ID = 1
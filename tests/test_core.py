@@ -8,8 +8,42 @@ test_django-kdl-wagtail
 Tests for `django-kdl-wagtail` core module.
 """
 
-from django.test import TestCase
-from kdl_wagtail.core.utils import paginate
+import base64
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from wagtail.core.models import Page, Site
+from wagtail.images.models import Image
+from wagtail.images.tests.utils import get_test_image_file
+
+from kdl_wagtail.core import sitemaps, sites, suggestions
+from kdl_wagtail.core.models import (
+    AnalyticsSettings, BaseStreamPage, FooterSettings, IndexPage, ProxyPage,
+    SearchPage, SearchSuggestion, SitemapPage, StreamPage
+)
+from kdl_wagtail.core.templatetags import kdl_wagtail_core_tags
+from kdl_wagtail.core.templatetags.kdl_wagtail_core_tags import (
+    get_analytics_id, get_footer_text
+)
+from kdl_wagtail.core.utils import (
+    krackdown, krackdown_anchor, krackdown_footnote, krackdown_link,
+    migrate_wagtail_page_type, paginate, paginate_keyset
+)
+
+from tests.utils import TempMediaRootMixin
 
 
 class TestKdl_wagtail_core(TestCase):
@@ -40,3 +74,922 @@ class TestKdl_wagtail_core(TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestKeysetPagination(TestCase):
+
+    def setUp(self):
+        root = Page.objects.get(depth=1)
+        self.index = root.add_child(instance=IndexPage(title='Index'))
+        for i in range(25):
+            self.index.add_child(instance=IndexPage(title='Child {}'.format(i)))
+
+        self.children = self.index.get_children().live()
+
+    def test_paginate_keyset(self):
+        pages = paginate(self.children, keyset='path')
+
+        self.assertEqual(10, len(pages))
+        self.assertTrue(pages.has_next())
+        self.assertFalse(pages.has_previous())
+        self.assertIsNone(pages.paginator.count)
+
+        titles = [p.title for p in pages]
+        pages = paginate(self.children, pages.next_cursor(), keyset='path')
+        pages = paginate(self.children, pages.next_cursor(), keyset='path')
+
+        self.assertEqual(5, len(pages))
+        self.assertFalse(pages.has_next())
+        self.assertTrue(pages.has_previous())
+
+        pages = paginate(
+            self.children, pages.previous_cursor(), keyset='path')
+        pages = paginate(
+            self.children, pages.previous_cursor(), keyset='path')
+
+        self.assertFalse(pages.has_previous())
+        self.assertEqual(titles, [p.title for p in pages])
+
+    def test_paginate_keyset_descending_non_unique_key(self):
+        seen = []
+        cursor = None
+        while True:
+            pages = paginate_keyset(
+                self.children, cursor, page_size=7, key='-depth', count=25)
+            seen.extend(p.pk for p in pages)
+            if not pages.has_next():
+                break
+            cursor = pages.next_cursor()
+
+        self.assertEqual(4, pages.paginator.num_pages)
+        self.assertEqual(sorted(seen), sorted(p.pk for p in self.children))
+
+    def test_paginate_keyset_invalid_cursor(self):
+        pages = paginate(self.children, 'not a cursor', keyset='path')
+
+        self.assertEqual(10, len(pages))
+        self.assertFalse(pages.has_previous())
+
+    def test_paginate_keyset_invalid_cursor_values(self):
+        for position in [['a', 'x', 1], ['a', None, 1], ['a', 2, 'y'],
+                         ['a', [2], 1], ['b', {'depth': 2}, 1]]:
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(position).encode('utf-8')).decode('ascii')
+            pages = paginate_keyset(self.children, cursor, key='-depth')
+
+            self.assertEqual(10, len(pages))
+            self.assertFalse(pages.has_previous())
+
+    def test_paginate_keyset_no_items(self):
+        self.assertIsNone(
+            paginate(Page.objects.none(), keyset='path'))
+
+    def test_index_page_keyset_count(self):
+        self.index.pagination_keyset = 'path'
+        self.index.pagination_count = 'estimate'
+
+        request = RequestFactory().get('/')
+        children = self.index.get_context(request)['children']
+
+        self.assertEqual(3, children.paginator.num_pages)
+
+
+class TestIndexPagePrefetch(TempMediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        root = Page.objects.get(depth=1)
+        self.index = root.add_child(instance=IndexPage(title='Index'))
+        for i in range(5):
+            image = Image.objects.create(
+                title='Image {}'.format(i), file=get_test_image_file())
+            # generates the listing rendition
+            image.get_rendition('fill-180x180-c100')
+            self.index.add_child(instance=IndexPage(
+                title='Child {}'.format(i), image=image))
+        self.index.add_child(instance=IndexPage(title='No image'))
+
+    def test_prefetch_children(self):
+        request = RequestFactory().get('/')
+        children = self.index._paginate(request)
+
+        with self.assertNumQueries(0):
+            for child in children:
+                if child.image:
+                    child.image.get_rendition('fill-180x180-c100').img_tag()
+
+
+class TestSitemapPage(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        self.site = Site.objects.get(is_default_site=True)
+        home = self.site.root_page
+        self.b = home.add_child(instance=IndexPage(title='B'))
+        self.a = home.add_child(instance=IndexPage(title='A'))
+        self.a.add_child(instance=IndexPage(title='A2'))
+        self.a.add_child(instance=IndexPage(title='A1'))
+        self.a.add_child(instance=IndexPage(title='Draft', live=False))
+
+        self.sitemap = SitemapPage(title='Sitemap')
+
+    def test_get_sitemap_tree(self):
+        # the site root paths are cached by wagtail
+        Site.get_site_root_paths()
+
+        with self.assertNumQueries(1):
+            tree = self.sitemap.get_sitemap_tree(self.site)
+
+        self.assertEqual(['A', 'B'], [node.title for node in tree])
+        self.assertEqual(
+            ['A1', 'A2'], [node.title for node in tree[0].children])
+        self.assertEqual('/pages/a/a1/', tree[0].children[0].url)
+
+        with self.assertNumQueries(0):
+            self.sitemap.get_sitemap_tree(self.site)
+
+    def test_get_sitemap_tree_max_depth(self):
+        self.sitemap.sitemap_max_depth = 1
+        tree = self.sitemap.get_sitemap_tree(self.site)
+
+        self.assertEqual([], tree[0].children)
+
+    def test_sitemap_invalidated_on_publish(self):
+        self.sitemap.get_sitemap_tree(self.site)
+
+        self.b.add_child(instance=IndexPage(
+            title='B1', live=False)).save_revision().publish()
+
+        tree = self.sitemap.get_sitemap_tree(self.site)
+        self.assertEqual(['B1'], [node.title for node in tree[1].children])
+
+
+class TestXMLSitemaps(TestCase):
+
+    def setUp(self):
+        self.sitemap_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            KDL_WAGTAIL_SITEMAP_ROOT=self.sitemap_root)
+        self.settings_override.enable()
+
+        self.site = Site.objects.get(is_default_site=True)
+        home = self.site.root_page
+        for i in range(4):
+            home.add_child(instance=IndexPage(title='Page {}'.format(i)))
+        home.add_child(instance=ProxyPage(
+            title='Proxy', target_url='http://example.com/'))
+
+    def read(self, name):
+        path = os.path.join(self.sitemap_root, str(self.site.pk), name)
+        with open(path) as f:
+            return f.read()
+
+    def test_build_sitemaps(self):
+        call_command('build_sitemaps', chunk_size=2, stdout=StringIO())
+
+        index = self.read('sitemap.xml')
+        self.assertIn('http://localhost/sitemap-3.xml</loc>', index)
+        self.assertNotIn('sitemap-4.xml', index)
+
+        urls = ''.join(
+            self.read('sitemap-{}.xml'.format(i)) for i in range(1, 4))
+        self.assertEqual(5, urls.count('<url>'))
+        self.assertIn('/pages/page-0/</loc>', urls)
+        self.assertNotIn('example.com', urls)
+
+    def test_serve_sitemap_xml(self):
+        response = self.client.get('/sitemap.xml')
+        content = b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertEqual(200, response.status_code)
+        self.assertIn('http://testserver/sitemap-1.xml</loc>', content)
+
+        response = self.client.get('/sitemap-1.xml')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(5, content.count('<url>'))
+
+        response = self.client.get('/sitemap-2.xml')
+        self.assertEqual(404, response.status_code)
+
+    @override_settings(KDL_WAGTAIL_SITEMAP_CHUNK_SIZE=2)
+    def test_serve_sitemap_xml_sections(self):
+        response = self.client.get('/sitemap.xml')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        sections = content.count('<sitemap>')
+
+        urls = []
+        for section in range(1, sections + 1):
+            response = self.client.get('/sitemap-{}.xml'.format(section))
+            content = b''.join(response.streaming_content).decode('utf-8')
+            self.assertLessEqual(content.count('<url>'), 2)
+            urls.extend(content.split('<url>')[1:])
+
+        self.assertEqual(5, len(urls))
+        response = self.client.get('/sitemap-{}.xml'.format(sections + 1))
+        self.assertEqual(404, response.status_code)
+
+    def test_proxy_target_pages(self):
+        home = self.site.root_page
+        other_home = Page.objects.get(depth=1).add_child(
+            instance=IndexPage(title='Other'))
+        Site.objects.create(
+            hostname='other.example', port=80, root_page=other_home)
+        elsewhere = other_home.add_child(
+            instance=IndexPage(title='Elsewhere'))
+        page = Page.objects.get(title='Page 0')
+        for target in [elsewhere, elsewhere, page]:
+            home.add_child(instance=ProxyPage(
+                title='Proxy to {}'.format(target.title),
+                target_page=target))
+
+        pages = sitemaps.get_sitemap_pages(self.site)
+        titles = [p.title for p in pages]
+
+        self.assertEqual(1, titles.count('Elsewhere'))
+        self.assertEqual(1, titles.count('Page 0'))
+        self.assertNotIn('Other', titles)
+        self.assertEqual(6, len(titles))
+        self.assertIn(
+            'http://other.example/', ''.join(sitemaps.iter_sitemap_xml(pages)))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.sitemap_root)
+
+
+class TestCachedSettings(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get(is_default_site=True)
+        AnalyticsSettings._local_cache = {}
+        AnalyticsSettings.objects.create(site=self.site, analytics_id='UA-1')
+        FooterSettings._local_cache = {}
+
+    def test_settings_tags(self):
+        request = RequestFactory().get('/')
+        context = {'request': request}
+
+        self.assertEqual('UA-1', get_analytics_id(context)['analytics_id'])
+        get_footer_text(context)
+
+        # the site is resolved from the map of the sites
+        with self.assertNumQueries(0):
+            request = RequestFactory().get('/')
+            context = {'request': request}
+            self.assertEqual(
+                'UA-1', get_analytics_id(context)['analytics_id'])
+            get_footer_text(context)
+
+    def test_settings_invalidated_on_save(self):
+        AnalyticsSettings.for_site_cached(self.site)
+
+        s = AnalyticsSettings.objects.get(site=self.site)
+        s.analytics_id = 'UA-2'
+        s.save()
+
+        self.assertEqual(
+            'UA-2', AnalyticsSettings.for_site_cached(self.site).analytics_id)
+
+
+class TestStreamPageCache(TestCase):
+
+    def setUp(self):
+        home = Site.objects.get(is_default_site=True).root_page
+        self.page = home.add_child(instance=StreamPage(title='Stream'))
+        self.page.save_revision().publish()
+        self.page.refresh_from_db()
+        self.request = RequestFactory().get('/')
+
+    def test_body_cache_key(self):
+        self.assertIsNone(self.page.get_body_cache_key(self.request))
+
+        self.page.block_cache_timeout = 60
+        key = self.page.get_body_cache_key(self.request)
+        self.assertIsNotNone(key)
+
+        self.request.is_preview = True
+        self.assertIsNone(self.page.get_body_cache_key(self.request))
+
+    def test_body_cache_key_changes_on_publish(self):
+        self.page.body_cache_timeout = 60
+        key = self.page.get_body_cache_key(self.request)
+
+        self.page.save_revision().publish()
+        self.page.refresh_from_db()
+        self.assertNotEqual(key, self.page.get_body_cache_key(self.request))
+
+
+@override_settings(TEMPLATES=[{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {
+        'context_processors': [
+            'django.template.context_processors.request',
+        ],
+        'loaders': [
+            ('django.template.loaders.locmem.Loader', {
+                'base.html': '{% block main %}{% endblock %}',
+            }),
+            'django.template.loaders.app_directories.Loader',
+        ],
+    },
+}])
+class TestStreamPageRenderCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        home = Site.objects.get(is_default_site=True).root_page
+        self.page = home.add_child(instance=StreamPage(title='Stream'))
+        self.set_body('First')
+
+    def set_body(self, text, publish=True):
+        self.page.body = json.dumps([{
+            'type': 'richtext_block', 'value': '<p>{}</p>'.format(text),
+            'id': 'block-1',
+        }])
+        if publish:
+            self.page.save_revision().publish()
+            self.page.refresh_from_db()
+
+    def render(self):
+        request = RequestFactory().get('/')
+        return self.page.serve(request).render().content.decode('utf-8')
+
+    def assert_render_cached(self):
+        self.assertIn('First', self.render())
+
+        # rendered from the cache, without the unpublished changes
+        self.set_body('Draft', publish=False)
+        self.assertIn('First', self.render())
+
+        self.set_body('Second')
+        content = self.render()
+        self.assertIn('Second', content)
+        self.assertNotIn('First', content)
+
+    def test_body_cache(self):
+        self.page.body_cache_timeout = 60
+        self.assert_render_cached()
+
+    def test_block_cache(self):
+        self.page.block_cache_timeout = 60
+        self.assert_render_cached()
+
+    def test_body_not_cached(self):
+        self.assertIn('First', self.render())
+
+        self.set_body('Draft', publish=False)
+        self.assertIn('Draft', self.render())
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'template_fragments': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'template_fragments',
+        },
+    })
+    def test_is_body_cached_in_template_fragments_cache(self):
+        self.page.body_cache_timeout = 60
+        key = self.page.get_body_cache_key(RequestFactory().get('/'))
+        self.assertFalse(self.page.is_body_cached(key))
+
+        self.render()
+        self.assertTrue(self.page.is_body_cached(key))
+
+
+class TestStreamPageRenditions(TempMediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        images = [
+            Image.objects.create(
+                title='Image {}'.format(i), file=get_test_image_file())
+            for i in range(6)
+        ]
+
+        def image_value(image, alignment=''):
+            return {'image': image.pk, 'alignment': alignment}
+
+        body = [
+            {'type': 'image_block', 'value': image_value(images[0])},
+            {'type': 'image_block',
+             'value': image_value(images[1], 'full-width')},
+            {'type': 'gallery_block', 'value': {
+                'images_block': [image_value(image) for image in images[2:]]
+            }},
+        ]
+
+        home = Site.objects.get(is_default_site=True).root_page
+        self.page = home.add_child(instance=StreamPage(
+            title='Stream', body=json.dumps(body)))
+
+    def test_prefetch_body_renditions(self):
+        self.page.prefetch_body_renditions()
+
+        with self.assertNumQueries(0):
+            for child in self.page.body:
+                for image, spec in child.block.get_rendition_specs(
+                        child.value):
+                    image.get_rendition(spec)
+
+        # the renditions now exist, they are fetched in one query
+        page = StreamPage.objects.get(pk=self.page.pk)
+        list(page.body)
+        with self.assertNumQueries(1):
+            page.prefetch_body_renditions()
+
+
+class TestGenerateRenditions(TempMediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.image = Image.objects.create(
+            title='Image', file=get_test_image_file())
+        body = [{'type': 'image_block', 'value': {
+            'image': self.image.pk, 'alignment': 'float-left'}}]
+
+        home = Site.objects.get(is_default_site=True).root_page
+        home.add_child(instance=IndexPage(title='Index', image=self.image))
+        home.add_child(instance=StreamPage(
+            title='Stream', body=json.dumps(body)))
+
+    def test_generate_renditions(self):
+        progress_file = os.path.join(self.media_root, 'progress.txt')
+        call_command(
+            'generate_renditions', workers=0, progress_file=progress_file,
+            stdout=StringIO())
+
+        self.assertEqual(
+            ['fill-180x180-c100', 'max-800x800', 'width-1024'],
+            sorted(self.image.renditions.values_list(
+                'filter_spec', flat=True))
+        )
+        with open(progress_file) as f:
+            self.assertEqual(3, len(f.readlines()))
+
+        out = StringIO()
+        call_command('generate_renditions', workers=0, stdout=out)
+        self.assertIn('0 renditions to generate', out.getvalue())
+
+    def test_failed_renditions_are_retried(self):
+        progress_file = os.path.join(self.media_root, 'progress.txt')
+        get_rendition = Image.get_rendition
+
+        def fail_width(image, spec):
+            if spec == 'width-1024':
+                raise ValueError('failed')
+            return get_rendition(image, spec)
+
+        with mock.patch.object(Image, 'get_rendition', fail_width):
+            call_command(
+                'generate_renditions', workers=0,
+                progress_file=progress_file, stdout=StringIO(),
+                stderr=StringIO())
+        with open(progress_file) as f:
+            self.assertEqual(2, len(f.readlines()))
+
+        out = StringIO()
+        call_command(
+            'generate_renditions', workers=0, progress_file=progress_file,
+            stdout=out)
+        self.assertIn('1 renditions to generate', out.getvalue())
+        self.assertTrue(self.image.renditions.filter(
+            filter_spec='width-1024').exists())
+
+
+class TestMigrateWagtailPageType(TestCase):
+
+    def setUp(self):
+        home = Site.objects.get(is_default_site=True).root_page
+        for i in range(5):
+            page = home.add_child(instance=IndexPage(
+                title='Page {}'.format(i), introduction='Intro {}'.format(i)))
+            page.save_revision()
+            page.save_revision()
+
+    def test_migrate_wagtail_page_type_in_batches(self):
+        def copy(page_from, page_to):
+            page_to.body = json.dumps([{
+                'type': 'heading_block',
+                'value': {'heading_text': page_from.title, 'size': 'h2'}
+            }])
+
+        mapping = {
+            'models': {
+                'from': ('kdl_wagtail_core', 'IndexPage'),
+                'to': ('kdl_wagtail_core', 'StreamPage'),
+            },
+            'copy': copy,
+        }
+
+        reported = []
+
+        def progress(count, total):
+            reported.append((count, total))
+
+        count = migrate_wagtail_page_type(
+            apps, None, mapping, batch_size=2, progress=progress)
+
+        self.assertEqual(5, count)
+        self.assertEqual([(2, 5), (4, 5), (5, 5)], reported)
+        self.assertFalse(IndexPage.objects.exists())
+
+        page = StreamPage.objects.get(title='Page 3')
+        self.assertEqual('Intro 3', page.introduction)
+        self.assertEqual('Page 3', page.body[0].value['heading_text'])
+        self.assertIsInstance(Page.objects.get(pk=page.pk).specific, StreamPage)
+
+        # only the latest revision is converted
+        revisions = page.revisions.order_by('-created_at', '-id')
+        self.assertEqual(
+            page.content_type_id,
+            json.loads(revisions[0].content_json)['content_type'])
+        self.assertNotEqual(
+            page.content_type_id,
+            json.loads(revisions[1].content_json)['content_type'])
+
+    def test_migrate_wagtail_page_type_queries_per_batch(self):
+        def migrate(titles):
+            mapping = {
+                'models': {
+                    'from': ('kdl_wagtail_core', 'IndexPage'),
+                    'to': ('kdl_wagtail_core', 'StreamPage'),
+                },
+                'select': lambda qs: qs.filter(title__in=titles),
+            }
+            return migrate_wagtail_page_type(
+                apps, None, mapping, batch_size=10)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(1, migrate(['Page 0']))
+
+        # a batch of 4 pages takes as many queries as a batch of 1
+        with self.assertNumQueries(len(queries)):
+            self.assertEqual(
+                4, migrate(['Page 1', 'Page 2', 'Page 3', 'Page 4']))
+
+    def test_migrate_wagtail_page_type(self):
+        mapping = {
+            'models': {
+                'from': ('kdl_wagtail_core', 'IndexPage'),
+                'to': ('kdl_wagtail_core', 'StreamPage'),
+            },
+        }
+        # historical models, as in a data migration
+        historical_apps = MigrationLoader(connection).project_state().apps
+        self.assertEqual(
+            5, migrate_wagtail_page_type(historical_apps, None, mapping))
+        self.assertFalse(IndexPage.objects.exists())
+        self.assertEqual(
+            'Intro 3', StreamPage.objects.get(title='Page 3').introduction)
+
+
+class TestKrackdown(TestCase):
+
+    text = (
+        '<p>{#top}See [the source](http://example.com/a_(b)) and the '
+        'note [^1], [^2] or [back](#top).</p>'
+    )
+
+    def test_krackdown_single_pass(self):
+        self.assertEqual(
+            krackdown_anchor(krackdown_footnote(krackdown_link(self.text))),
+            krackdown(self.text)
+        )
+
+    def test_krackdown_nested_markup(self):
+        for text in [
+            '[see {#a} here](http://x)',
+            '[note [^1]](http://x/{#b})',
+            '[^{#c}] and {#d[^2]} then {#[e](f)}',
+        ]:
+            self.assertEqual(
+                krackdown_anchor(krackdown_footnote(krackdown_link(text))),
+                krackdown(text), text
+            )
+
+    def test_krackdown_overlapping_markup(self):
+        # converted once, the output isn't scanned again
+        for text, html in [
+            ('[^a{#b]}', '<sup id="fnref:a{#b"><a href="#fn:a{#b">a{#b</a>'
+                         '</sup>}'),
+            ('{#a[^b}]', '<a id="a[^b"></a>]'),
+            ('[a](b{#c)}', '<a href="b{#c">a</a>}'),
+            ('[a]([^b)]', '<a href="[^b">a</a>]'),
+        ]:
+            self.assertEqual(html, krackdown(text), text)
+
+    @override_settings(KDL_WAGTAIL_KRACKDOWN_FILTERS=[
+        'kdl_wagtail.core.utils.krackdown_anchor'
+    ])
+    def test_krackdown_filter(self):
+        html = kdl_wagtail_core_tags.krackdown(self.text)
+
+        self.assertIn('<a id="top"></a>', html)
+        self.assertIn('[back](#top)', html)
+
+        with override_settings(KDL_WAGTAIL_KRACKDOWN_FILTERS=[
+            'kdl_wagtail.core.utils.krackdown'
+        ]):
+            self.assertEqual(
+                krackdown(self.text), kdl_wagtail_core_tags.krackdown(self.text))
+
+
+class TestSearchPage(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        home = Site.objects.get(is_default_site=True).root_page
+        self.search_page = home.add_child(
+            instance=SearchPage(title='Search'))
+        for i in range(3):
+            home.add_child(instance=StreamPage(
+                title='Stream {}'.format(i), slug='stream-{}'.format(i)))
+        for i in range(2):
+            home.add_child(instance=IndexPage(
+                title='Index {}'.format(i), slug='index-{}'.format(i)))
+        home.add_child(instance=StreamPage(
+            title='Draft', slug='draft', live=False))
+
+    def get_context(self, **params):
+        request = RequestFactory().get('/', params)
+        return self.search_page.get_context(request)
+
+    def test_search(self):
+        context = self.get_context(q='Stream')
+        hits = context['hits']
+        self.assertEqual(hits.paginator.count, 3)
+        self.assertTrue(all(isinstance(hit, StreamPage) for hit in hits))
+        self.assertEqual(context['search_phrase'], 'Stream')
+
+    def test_facets(self):
+        context = self.get_context(type='kdl_wagtail_core.indexpage')
+        self.assertEqual(
+            sorted(hit.title for hit in context['hits']),
+            ['Index 0', 'Index 1']
+        )
+        facets = {f['type']: f for f in context['search_facets']}
+        self.assertEqual(facets['kdl_wagtail_core.streampage']['count'], 3)
+        self.assertEqual(facets['kdl_wagtail_core.indexpage']['count'], 2)
+        self.assertTrue(facets['kdl_wagtail_core.indexpage']['selected'])
+        self.assertFalse(facets['kdl_wagtail_core.streampage']['selected'])
+
+        # unknown or non page types are ignored
+        context = self.get_context(type='kdl_wagtail_people.person')
+        self.assertEqual(context['hits'].paginator.count, 7)
+
+    def test_searchable_models(self):
+        self.search_page.searchable_models = ['kdl_wagtail_core.StreamPage']
+
+        context = self.get_context()
+        self.assertEqual(context['hits'].paginator.count, 3)
+        self.assertEqual(
+            [f['type'] for f in context['search_facets']],
+            ['kdl_wagtail_core.streampage']
+        )
+
+        context = self.get_context(type='kdl_wagtail_core.indexpage')
+        self.assertEqual(context['hits'].paginator.count, 3)
+
+    def test_only_displayed_hits_are_specific(self):
+        request = RequestFactory().get('/')
+        hits = paginate(self.search_page.get_search_hits(request), 1, 2)
+
+        with self.assertNumQueries(2):
+            # the hits (the home page and the search page), then the
+            # search page as a SearchPage
+            self.search_page.prefetch_hits(hits)
+        self.assertEqual(len(hits.object_list), 2)
+
+    def test_search_phrase_is_normalised(self):
+        request = RequestFactory().get('/', {'q': '  Stream \t 1 '})
+        self.assertEqual(
+            self.search_page.get_search_phrase(request), 'Stream 1')
+
+        request = RequestFactory().get('/', {'q': 'x' * 1000})
+        self.assertEqual(len(self.search_page.get_search_phrase(request)),
+                         self.search_page.search_phrase_max_length)
+
+    def test_hits_are_cached(self):
+        request = RequestFactory().get('/', {'q': 'Stream'})
+        # the public method returns pages
+        self.assertTrue(all(
+            isinstance(hit, Page)
+            for hit in self.search_page.get_search_hits(request)
+        ))
+
+        hits = self.search_page._get_search_hit_ids(request)
+        self.assertEqual(len(hits), 3)
+        self.assertTrue(all(isinstance(hit, tuple) for hit in hits))
+
+        request = RequestFactory().get('/', {'q': ' stream  '})
+        with self.assertNumQueries(0):
+            # the site and the hits come from the caches
+            self.assertEqual(
+                self.search_page._get_search_hit_ids(request), hits)
+
+        context = self.get_context(q='STREAM')
+        self.assertEqual(
+            sorted(hit.title for hit in context['hits']),
+            ['Stream 0', 'Stream 1', 'Stream 2']
+        )
+
+    def test_facets_are_cached_regardless_of_type(self):
+        def get_facets(**params):
+            request = RequestFactory().get('/', dict(q='Stream', **params))
+            self.search_page.get_search_type(request)
+            return self.search_page.get_search_facets(request)
+
+        facets = get_facets(type='kdl_wagtail_core.indexpage')
+        get_facets(type='kdl_wagtail_core.streampage')
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [f['count'] for f in get_facets()],
+                [f['count'] for f in facets]
+            )
+
+    def test_publishing_invalidates_cached_hits(self):
+        self.assertEqual(self.get_context(q='Stream')['hits'].paginator.count, 3)
+        self.assertEqual(self.get_context()['hits'].paginator.count, 7)
+
+        draft = StreamPage.objects.get(slug='draft')
+        draft.title = 'Stream 3'
+        draft.save_revision().publish()
+
+        self.assertEqual(self.get_context(q='Stream')['hits'].paginator.count, 4)
+        self.assertEqual(self.get_context()['hits'].paginator.count, 8)
+
+    def test_order(self):
+        now = timezone.now()
+        for i, page in enumerate(StreamPage.objects.live().order_by('title')):
+            Page.objects.filter(pk=page.pk).update(
+                last_published_at=now + timedelta(days=i))
+
+        for params in [{'q': 'Stream'}, {'type': 'kdl_wagtail_core.streampage'}]:
+            context = self.get_context(order='date', **params)
+            self.assertEqual(context['search_order'], 'date')
+            self.assertEqual(
+                [hit.title for hit in context['hits']],
+                ['Stream 2', 'Stream 1', 'Stream 0']
+            )
+
+        # unknown orders are ignored
+        context = self.get_context(q='Stream', order='title')
+        self.assertEqual(context['search_order'], 'relevance')
+        self.assertEqual(context['hits'].paginator.count, 3)
+
+    def test_too_many_hits_are_not_cached(self):
+        self.search_page.search_cache_max_hits = 2
+        hits = self.search_page._get_search_hit_ids(
+            RequestFactory().get('/', {'q': 'Stream'}))
+        self.assertNotIsInstance(hits, list)
+        self.assertEqual(hits.count(), 3)
+
+
+class TestSearchSuggestions(TestCase):
+
+    def setUp(self):
+        home = Site.objects.get(is_default_site=True).root_page
+        self.search_page = home.add_child(
+            instance=SearchPage(title='Search'))
+        for title in ['The  Stream', 'Stream 1', 'Streams', 'Index']:
+            home.add_child(instance=StreamPage(title=title))
+        home.add_child(instance=StreamPage(title='Stream draft', live=False))
+
+        out = StringIO()
+        call_command('build_search_suggestions', stdout=out)
+        self.assertIn('written', out.getvalue())
+
+    def get_titles(self, phrase):
+        return [s['title'] for s in suggestions.get_suggestions(phrase)]
+
+    def test_get_terms(self):
+        self.assertEqual(
+            suggestions.get_terms(' The  Stream '),
+            [(0, 'the stream'), (1, 'stream')]
+        )
+
+    def test_suggestions(self):
+        # titles starting with the phrase first
+        self.assertEqual(
+            self.get_titles('STRE'),
+            ['Stream 1', 'Streams', 'The Stream']
+        )
+        self.assertEqual(self.get_titles('stream  1'), ['Stream 1'])
+        self.assertEqual(self.get_titles('xyz'), [])
+        self.assertEqual(self.get_titles(' '), [])
+
+    def test_short_phrases_are_ignored(self):
+        self.assertEqual(self.get_titles('st'), [])
+        self.assertEqual(
+            [s['title'] for s in suggestions.get_suggestions(
+                'st', min_length=2)],
+            ['Stream 1', 'Streams', 'The Stream']
+        )
+
+        request = RequestFactory().get('/', {'q': 'st'})
+        response = self.search_page.suggest(request)
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8'))['suggestions'], [])
+
+    def test_index_is_updated_on_publish(self):
+        draft = StreamPage.objects.get(title='Stream draft')
+        draft.save_revision().publish()
+        self.assertIn('Stream draft', self.get_titles('stream'))
+
+        draft.refresh_from_db()
+        draft.unpublish()
+        self.assertNotIn('Stream draft', self.get_titles('stream'))
+
+        page = StreamPage.objects.get(title='Streams')
+        page.delete()
+        self.assertNotIn('Streams', self.get_titles('stream'))
+        self.assertFalse(SearchSuggestion.objects.filter(
+            object_id=page.pk).exists())
+
+    def test_suggest_searchable_models(self):
+        # the subclasses of the searchable models are suggested too
+        self.search_page.searchable_models = [BaseStreamPage]
+        for phrase, titles in [('stream 1', ['Stream 1']), ('sea', [])]:
+            request = RequestFactory().get('/', {'q': phrase})
+            data = json.loads(self.search_page.suggest(request).content)
+            self.assertEqual(
+                [s['title'] for s in data['suggestions']], titles)
+
+    def test_suggest(self):
+        view, args, kwargs = self.search_page.resolve_subpage('/suggest/')
+        request = RequestFactory().get('/', {'q': 'stream', 'limit': 2})
+
+        with self.assertNumQueries(4):
+            # the suggestions, then the urls of the pages (the pages, the
+            # site and the site root paths)
+            response = view(request, *args, **kwargs)
+
+        data = json.loads(response.content.decode('utf-8'))['suggestions']
+        self.assertEqual([s['title'] for s in data], ['Stream 1', 'Streams'])
+        self.assertEqual(data[0]['type'], 'kdl_wagtail_core.streampage')
+        self.assertEqual(
+            data[0]['url'], StreamPage.objects.get(title='Stream 1').url)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class TestSites(TestCase):
+
+    def setUp(self):
+        sites.invalidate_site_map()
+        self.default = Site.objects.get(is_default_site=True)
+
+    def tearDown(self):
+        # the sites created by the test are rolled back
+        sites.invalidate_site_map()
+
+    def get_request(self, host):
+        port = host.split(':')[1] if ':' in host else '80'
+        return RequestFactory().get('/', HTTP_HOST=host, SERVER_PORT=port)
+
+    def get_site(self, host):
+        return sites.get_site(self.get_request(host))
+
+    def test_get_site(self):
+        self.assertEqual(self.get_site('localhost'), self.default)
+
+        with self.assertNumQueries(0):
+            request = RequestFactory().get('/')
+            self.assertEqual(sites.get_site(request), self.default)
+            # Wagtail finds the site on the request
+            self.assertEqual(Site.find_for_request(request), self.default)
+
+    def test_site_map_is_refreshed(self):
+        other = Site.objects.create(
+            hostname='other.example', port=80,
+            root_page=self.default.root_page)
+        self.assertEqual(self.get_site('other.example'), other)
+        self.assertEqual(self.get_site('other.example:8000'), other)
+        self.assertEqual(self.get_site('unknown.example'), self.default)
+
+        other_8000 = Site.objects.create(
+            hostname='other.example', port=8000,
+            root_page=self.default.root_page)
+        self.assertEqual(self.get_site('other.example'), other)
+        self.assertEqual(self.get_site('other.example:8000'), other_8000)
+        # more than one site with that hostname, none on that port
+        self.assertEqual(self.get_site('other.example:8080'), self.default)
+
+        other.delete()
+        self.assertEqual(self.get_site('other.example'), other_8000)
+
+    def test_matches_wagtail(self):
+        Site.objects.create(
+            hostname='other.example', port=8000,
+            root_page=self.default.root_page)
+        for host in ['localhost', 'other.example', 'other.example:8000',
+                     'unknown.example:8000']:
+            self.assertEqual(
+                self.get_site(host),
+                Site._find_for_request(self.get_request(host)), host)
@@ -8,9 +8,22 @@ test_django-kdl-wagtail
 Tests for `django-kdl-wagtail` people module.
 """
 
+from unittest import mock
+
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.test import TestCase, override_settings
-from kdl_wagtail.people.models import Person, get_person_model
+from django.test import RequestFactory, TestCase, override_settings
+from wagtail.core.models import Site
+from wagtail.images.models import Image
+from wagtail.images.tests.utils import get_test_image_file
+
+from kdl_wagtail.core import suggestions
+from kdl_wagtail.people.models import (
+    PeopleIndexPage, PeopleIndexPersonRelationship, Person, PersonPage,
+    get_person_model, update_people_pages_index
+)
+
+from tests.utils import TempMediaRootMixin
 
 
 class TestKdl_wagtail_people(TestCase):
@@ -36,3 +49,161 @@ class TestKdl_wagtail_people(TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestPeopleIndexPage(TempMediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        home = Site.objects.get(is_default_site=True).root_page
+        self.index = home.add_child(instance=PeopleIndexPage(title='People'))
+
+        for i in range(4):
+            image = Image.objects.create(
+                title='Image {}'.format(i), file=get_test_image_file())
+            image.get_rendition('fill-180x180-c100')
+            person = Person.objects.create(
+                name='Person {}'.format(i), image=image)
+            PeopleIndexPersonRelationship.objects.create(
+                page=self.index, person=person)
+            if i % 2:
+                home.add_child(instance=PersonPage(
+                    title='Draft {}'.format(i), person=person, live=False))
+                home.add_child(instance=PersonPage(
+                    title='Person {}'.format(i), person=person))
+
+    def test_people(self):
+        request = RequestFactory().get('/')
+        people = self.index.get_context(request)['people']
+
+        with self.assertNumQueries(0):
+            titles = []
+            for p in people:
+                page = p.person.primary_page
+                titles.append(page.title if page else None)
+                p.person.image.get_rendition('fill-180x180-c100').url
+
+        self.assertEqual([None, 'Person 1', None, 'Person 3'], titles)
+
+    def test_primary_page(self):
+        person = Person.objects.get(name='Person 1')
+        self.assertEqual('Person 1', person.primary_page.title)
+
+
+class FakeSearchBackend:
+
+    def __init__(self):
+        self.added = []
+
+    def add_bulk(self, model, objs):
+        self.added.append((model, [obj.title for obj in objs]))
+
+
+class TestPeopleSearchIndex(TestCase):
+
+    def setUp(self):
+        home = Site.objects.get(is_default_site=True).root_page
+        self.people = [
+            Person.objects.create(name='Person {}'.format(i)) for i in range(3)
+        ]
+        for i in range(2):
+            index_page = home.add_child(
+                instance=PeopleIndexPage(title='People {}'.format(i)))
+            for person in self.people[i:]:
+                PeopleIndexPersonRelationship.objects.create(
+                    page=index_page, person=person)
+        for person in self.people:
+            home.add_child(instance=PersonPage(
+                title=person.name, person=person))
+
+    def test_indexed_objects(self):
+        pages = list(PeopleIndexPage.get_indexed_objects())
+        with self.assertNumQueries(0):
+            names = [
+                str(r.person)
+                for page in pages
+                for r in page.peopleindex_person_relationship.all()
+            ]
+        self.assertEqual(
+            names, ['Person 0', 'Person 1', 'Person 2', 'Person 1', 'Person 2'])
+
+    def test_person_change_updates_pages_index(self):
+        backend = FakeSearchBackend()
+        with mock.patch(
+            'kdl_wagtail.people.models.get_search_backends',
+            return_value=[backend]
+        ):
+            self.people[0].name = 'Someone'
+            self.people[0].save()
+            self.assertEqual(backend.added, [
+                (PersonPage, ['Person 0']), (PeopleIndexPage, ['People 0']),
+            ])
+
+            backend.added = []
+            update_people_pages_index(
+                [p.pk for p in self.people[1:]], chunk_size=1)
+            self.assertEqual(backend.added, [
+                (PersonPage, ['Person 1']), (PersonPage, ['Person 2']),
+                (PeopleIndexPage, ['People 0']),
+                (PeopleIndexPage, ['People 1']),
+            ])
+
+
+class TestPersonThumbnail(TempMediaRootMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+
+        self.image = Image.objects.create(
+            title='Image', file=get_test_image_file())
+        for i in range(3):
+            Person.objects.create(name='Person {}'.format(i), image=self.image)
+        Person.objects.create(name='No image')
+
+    def test_thumbnail_generated_on_save(self):
+        self.assertTrue(self.image.renditions.filter(
+            filter_spec='fill-50x50').exists())
+
+        person = Person.objects.get(name='Person 0')
+        with self.assertNumQueries(0):
+            self.assertIn('<img', person.thumbnail)
+
+    def test_prefetch_thumbnails(self):
+        cache.clear()
+        people = list(Person.objects.order_by('pk'))
+
+        with self.assertNumQueries(2):
+            Person.prefetch_thumbnails(people)
+        with self.assertNumQueries(0):
+            thumbnails = [p.thumbnail for p in people]
+        self.assertEqual(len(set(thumbnails[:3])), 1)
+        self.assertIsNone(thumbnails[3])
+
+        people = list(Person.objects.order_by('pk'))
+        with self.assertNumQueries(0):
+            Person.prefetch_thumbnails(people)
+
+        # changing the image invalidates the cached thumbnails
+        self.image.save()
+        people = list(Person.objects.all())
+        with self.assertNumQueries(2):
+            Person.prefetch_thumbnails(people)
+
+
+class TestPersonSuggestions(TestCase):
+
+    def test_names_are_suggested(self):
+        person = Person.objects.create(name='Jane Smith')
+        self.assertEqual(
+            [s['title'] for s in suggestions.get_suggestions('smi')],
+            ['Jane Smith']
+        )
+
+        person.name = 'Jane Doe'
+        person.save()
+        self.assertEqual(suggestions.get_suggestions('smi'), [])
+
+        person.delete()
+        self.assertEqual(suggestions.get_suggestions('jane'), [])
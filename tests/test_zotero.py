@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_django-kdl-wagtail
+------------
+
+Tests for `django-kdl-wagtail` zotero module.
+"""
+
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+from wagtail.core.blocks import RichTextBlock, StreamBlock, StreamValue
+from wagtail.core.models import Site
+from wagtail.core.rich_text import RichText
+from wagtail.search.backends import get_search_backend
+
+from kdl_wagtail.core.models import RichTextPage
+from kdl_wagtail.core.templatetags.kdl_wagtail_core_tags import url_replace
+from kdl_wagtail.zotero.management.commands.zotero_import import Command
+from kdl_wagtail.zotero.models import (
+    Bibliography, BibliographyIndexPage, ZoteroSync, render_bibliography_html
+)
+from kdl_wagtail.zotero.templatetags.kdl_wagtail_zotero_tags import (
+    get_bibliography
+)
+
+
+class FakeZotero:
+    """Stand-in for the pyzotero client, serving `items` from memory."""
+
+    def __init__(self, items, failures=0):
+        self.items = items
+        self.requests = []
+        # number of requests failing before the next one succeeds
+        self.failures = failures
+
+    def last_modified_version(self):
+        return max([item['version'] for item in self.items] + [0])
+
+    def collection_items(self, collection_id, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('Zotero is down')
+
+        self.requests.append(kwargs)
+        if kwargs.get('format') == 'keys':
+            return '\n'.join(item['key'] for item in self.items).encode()
+
+        items = [
+            dict(item, citation='<span>{} ({})</span>'.format(
+                item['key'], kwargs['style']))
+            for item in self.items
+            if item['version'] > kwargs.get('since', -1)
+        ]
+        start = kwargs.get('start', 0)
+        return items[start:start + kwargs.get('limit', len(items))]
+
+    def everything(self, items):
+        return items
+
+
+def make_zotero_item(key, author='Austen', item_type='book', version=1):
+    return {
+        'key': key,
+        'version': version,
+        'data': {'itemType': item_type},
+        'meta': {'creatorSummary': author},
+        'links': {'alternate': {'href': 'https://zotero.org/' + key}},
+        'bib': '<div class="csl-entry">{} ({})</div>'.format(key, author),
+    }
+
+
+ZOTERO_SETTINGS = {
+    'KDL_WAGTAIL_ZOTERO_COLLECTION': 'C1',
+    'KDL_WAGTAIL_ZOTERO_NOTE_STYLE': 'note-style',
+    'KDL_WAGTAIL_ZOTERO_SHORTNOTE_STYLE': 'shortnote-style',
+}
+
+
+class TestBibliographyIndexPage(TestCase):
+
+    def setUp(self):
+        root = Site.objects.get(is_default_site=True).root_page
+        self.index = root.add_child(
+            instance=BibliographyIndexPage(title='Bibliography'))
+
+        for i, (author, item_type) in enumerate([
+            ('Austen', 'book'), ('Brontë', 'book'), ('Byron', 'journalArticle'),
+        ] * 5):
+            Bibliography.objects.create(
+                key='K{}'.format(i), item_type=item_type, author=author,
+                order=i, citation='<p>{}</p>'.format(author),
+                url='https://example.org/{}'.format(i),
+                bib='<p>{} ({})</p>'.format(author, item_type),
+            )
+
+    def get_context(self, **params):
+        request = RequestFactory().get('/', params)
+        return self.index.get_context(request)
+
+    def test_keyset_pagination(self):
+        entries = self.get_context()['entries']
+        self.assertTrue(entries.is_keyset)
+        self.assertEqual([e.order for e in entries], list(range(10)))
+        self.assertEqual(entries.paginator.num_pages, 2)
+
+        entries = self.get_context(cursor=entries.next_cursor())['entries']
+        self.assertEqual([e.order for e in entries], list(range(10, 15)))
+        self.assertFalse(entries.has_next())
+
+    def test_keyset_pagination_without_order(self):
+        Bibliography.objects.filter(order__gte=3).update(order=None)
+
+        keys = []
+        entries = self.get_context()['entries']
+        while True:
+            keys.extend(e.key for e in entries)
+            if not entries.has_next():
+                break
+            entries = self.get_context(cursor=entries.next_cursor())['entries']
+
+        self.assertEqual(keys, [
+            'K{}'.format(i) for i in range(15)
+        ])
+
+        entries = self.get_context(
+            cursor=entries.previous_cursor())['entries']
+        self.assertEqual([e.key for e in entries], keys[:10])
+
+    def test_filters(self):
+        context = self.get_context(item_type='book', author='b')
+        self.assertEqual(
+            [e.author for e in context['entries']], ['Brontë'] * 5)
+        self.assertEqual(
+            list(context['item_types']), ['book', 'journalArticle'])
+
+        context = self.get_context(author='Byron')
+        self.assertEqual(context['entries_filters']['author'], 'B')
+        self.assertEqual(len(context['entries']), 10)
+
+    def test_search(self):
+        entries = self.get_context(q='Austen', item_type='book')['entries']
+        self.assertFalse(getattr(entries, 'is_keyset', False))
+        self.assertEqual([e.author for e in entries], ['Austen'] * 5)
+
+    def test_search_by_author_initial(self):
+        backend = get_search_backend()
+        with mock.patch.object(
+                backend, 'search', wraps=backend.search) as search:
+            with mock.patch(
+                    'kdl_wagtail.zotero.models.get_search_backend',
+                    return_value=backend):
+                entries = self.get_context(q='Byron', author='b')['entries']
+
+        self.assertEqual([e.author for e in entries], ['Byron'] * 5)
+        # the lookups supported by all the search backends
+        queryset = search.call_args[0][1]
+        self.assertEqual(
+            {'exact'},
+            {child.lookup_name for child in queryset.query.where.children}
+        )
+
+    def test_pagination_links_keep_the_query_string(self):
+        request = RequestFactory().get(
+            '/', {'q': 'Austen', 'page': '1', 'cursor': 'x'})
+        self.assertEqual(
+            url_replace({'request': request}, page=2, cursor=None),
+            'q=Austen&page=2'
+        )
+
+
+class TestBibliographyHTML(TestCase):
+
+    def test_html_rendered_on_save(self):
+        b = Bibliography.objects.create(
+            key='K1', item_type='book', author='Austen', order=1,
+            url='https://example.org/1',
+            citation='<p>Austen, <i>Emma</i></p>',
+            bib=(
+                '<div class="csl-bib-body" style="line-height: 1.35">'
+                '<div class="csl-entry">Austen. <i>Emma</i>.'
+                '<script>alert(1)</script></div></div>'
+            ),
+        )
+
+        self.assertEqual(
+            b.bib_html,
+            '<div class="csl-bib-body" style="line-height: 1.35">'
+            '<div class="csl-entry">Austen. <i>Emma</i>.alert(1)</div></div>'
+        )
+        self.assertEqual(b.citation_html, '<p>Austen, <i>Emma</i></p>')
+        self.assertEqual(b.citation_short_html, '')
+        self.assertEqual(b.entry, b.bib_html)
+
+    def test_csl_styles_are_kept(self):
+        html = render_bibliography_html(
+            '<div class="csl-entry" style="padding-left: 1em; '
+            'text-indent:-1em; background: url(https://example.org/)">'
+            '<span style="font-variant:small-caps;">Austen</span>'
+            '<span style="position: fixed">Emma</span></div>'
+        )
+
+        self.assertEqual(
+            html,
+            '<div class="csl-entry" style="padding-left: 1em; '
+            'text-indent: -1em"><span style="font-variant: small-caps">'
+            'Austen</span><span>Emma</span></div>'
+        )
+
+
+@override_settings(**ZOTERO_SETTINGS)
+class TestZoteroImport(TestCase):
+
+    def run_import(self, zot, *args):
+        out = StringIO()
+        with mock.patch.object(Command, 'get_client', return_value=zot):
+            call_command(
+                'zotero_import', *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_bulk_import(self):
+        zot = FakeZotero([make_zotero_item('K{}'.format(i)) for i in range(5)])
+        zot.items[0]['meta'] = {}
+
+        with self.assertNumQueries(12):
+            # 2 batches of a select and an insert in a transaction (6), then
+            # the library version is saved (6)
+            out = self.run_import(zot, '--batch-size', '3')
+        self.assertIn('5 bibliography entries imported (5 created', out)
+        self.assertEqual(
+            [r.get('style') for r in zot.requests],
+            [None, 'note-style', 'shortnote-style']
+        )
+
+        b = Bibliography.objects.get(key='K1')
+        self.assertEqual(b.order, 1)
+        self.assertEqual(b.author, 'Austen')
+        self.assertEqual(b.citation, '<span>K1 (note-style)</span>')
+        self.assertEqual(b.citation_short, '<span>K1 (shortnote-style)</span>')
+        self.assertEqual(b.bib_html, '<div class="csl-entry">K1 (Austen)</div>')
+        self.assertIsNone(Bibliography.objects.get(key='K0').author)
+
+        Bibliography.objects.filter(key='K0').update(author='Byron')
+        zot.items[1]['bib'] = '<div class="csl-entry">K1 (2nd edition)</div>'
+        out = self.run_import(zot)
+        self.assertIn('(0 created, 5 updated)', out)
+        self.assertEqual(Bibliography.objects.count(), 5)
+        self.assertEqual(
+            Bibliography.objects.get(key='K1').bib_html,
+            '<div class="csl-entry">K1 (2nd edition)</div>'
+        )
+        # the author is kept when Zotero doesn't provide one
+        self.assertEqual(Bibliography.objects.get(key='K0').author, 'Byron')
+
+    def test_incremental_import(self):
+        zot = FakeZotero([make_zotero_item('K{}'.format(i)) for i in range(4)])
+        self.run_import(zot, '--incremental')
+        self.assertEqual(ZoteroSync.get_version('C1'), 1)
+
+        # K1 is modified, K2 removed and K4 added first
+        zot.items[1]['bib'] = '<div class="csl-entry">K1 (2nd edition)</div>'
+        zot.items[1]['version'] = 2
+        del zot.items[2]
+        zot.items.insert(0, make_zotero_item('K4', version=3))
+        zot.requests = []
+
+        out = self.run_import(zot, '--incremental')
+        self.assertIn('since version 1', out)
+        self.assertIn('2 items fetched', out)
+        self.assertIn('(1 created, 1 updated)', out)
+        self.assertIn('1 bibliography entries reordered, 1 deleted', out)
+        self.assertEqual(ZoteroSync.get_version('C1'), 3)
+        self.assertEqual(
+            [r.get('since') for r in zot.requests], [None, 1, 1])
+
+        self.assertEqual(
+            list(Bibliography.objects.values_list('key', 'order')),
+            [('K4', 0), ('K0', 1), ('K1', 2), ('K3', 3)]
+        )
+        self.assertEqual(
+            Bibliography.objects.get(key='K1').bib_html,
+            '<div class="csl-entry">K1 (2nd edition)</div>'
+        )
+
+    def test_concurrent_import(self):
+        zot = FakeZotero(
+            [make_zotero_item('K{:03}'.format(i)) for i in range(250)],
+            failures=1
+        )
+
+        with mock.patch.object(Command, 'retry_delay', 0):
+            out = self.run_import(zot, '--workers', '3')
+
+        self.assertIn('250 bibliography entries imported', out)
+        # the keys, then 3 pages of each style
+        self.assertEqual(len(zot.requests), 7)
+        self.assertEqual(
+            sorted((r['style'], r['start']) for r in zot.requests[1:]), [
+                ('note-style', 0), ('note-style', 100), ('note-style', 200),
+                ('shortnote-style', 0), ('shortnote-style', 100),
+                ('shortnote-style', 200),
+            ]
+        )
+        self.assertEqual(
+            list(Bibliography.objects.values_list('order', flat=True)),
+            list(range(250))
+        )
+        b = Bibliography.objects.get(key='K123')
+        self.assertEqual(b.order, 123)
+        self.assertEqual(b.citation_short, '<span>K123 (shortnote-style)</span>')
+
+    def test_import_fails_after_retries(self):
+        zot = FakeZotero([make_zotero_item('K1')], failures=3)
+
+        with mock.patch.object(Command, 'retry_delay', 0):
+            with self.assertRaises(ConnectionError):
+                self.run_import(zot, '--retries', '2')
+
+    def test_delete_unused_entries(self):
+        for i in range(5):
+            Bibliography.objects.create(
+                key='K{}'.format(i), item_type='book', order=i,
+                citation='', url='https://example.org/{}'.format(i), bib='')
+        used = set(Bibliography.objects.filter(
+            key__in=['K1', 'K3']).values_list('pk', flat=True))
+
+        # no model refers to the bibliography in the tests
+        self.assertEqual(Bibliography.get_used_ids(), set())
+
+        zot = FakeZotero([])
+        with mock.patch.object(Bibliography, 'get_used_ids', return_value=used):
+            out = self.run_import(zot, '--delete', '--dry-run')
+            self.assertIn('3 of 5 bibliography entries are not being used', out)
+            self.assertEqual(Bibliography.objects.count(), 5)
+            self.assertEqual(zot.requests, [])
+
+            out = self.run_import(zot, '--delete', '--batch-size', '2')
+            self.assertIn('3 of 5 bibliography entries deleted', out)
+
+        self.assertEqual(
+            list(Bibliography.objects.values_list('key', flat=True)),
+            ['K1', 'K3']
+        )
+
+    def test_delete_keeps_cited_entries(self):
+        for i in range(3):
+            Bibliography.objects.create(
+                key='KEY0000{}'.format(i), item_type='book', order=i,
+                citation='', url='https://example.org/{}'.format(i), bib='')
+
+        home = Site.objects.get(is_default_site=True).root_page
+        home.add_child(instance=RichTextPage(
+            title='Cited', body=(
+                '<p>See <a href="https://www.zotero.org/groups/1/items/'
+                'KEY00001">Austen</a> and <a href="https://www.zotero.org/'
+                'jsmith/items/KEY00002">Eliot</a>.</p>'
+            )
+        ))
+        self.assertEqual(
+            Bibliography.get_used_ids(),
+            set(Bibliography.objects.filter(
+                key__in=['KEY00001', 'KEY00002']).values_list('pk', flat=True))
+        )
+
+        out = self.run_import(FakeZotero([]), '--delete')
+        self.assertIn('1 of 3 bibliography entries deleted', out)
+        self.assertEqual(
+            list(Bibliography.objects.values_list('key', flat=True)),
+            ['KEY00001', 'KEY00002']
+        )
+
+
+class TestBibliographyResolver(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for i in range(3):
+            Bibliography.objects.create(
+                key='ABCD000{}'.format(i), item_type='book', order=i,
+                citation='', url='https://example.org/{}'.format(i),
+                bib='<p>Entry {}</p>'.format(i))
+
+    def cite(self, key):
+        return '<a href="https://www.zotero.org/groups/1/items/{}">{}</a>'.format(
+            key, key)
+
+    def test_get_cited_keys(self):
+        body = StreamValue(StreamBlock([('paragraph', RichTextBlock())]), [
+            ('paragraph', RichText(self.cite('ABCD0002') + self.cite('ABCD0001'))),
+            ('paragraph', RichText(self.cite('ABCD0002'))),
+        ])
+        self.assertEqual(
+            Bibliography.get_cited_keys(body), ['ABCD0002', 'ABCD0001'])
+        self.assertEqual(
+            Bibliography.get_cited_keys([self.cite('ABCD0000'), body]),
+            ['ABCD0000', 'ABCD0002', 'ABCD0001']
+        )
+        self.assertEqual(Bibliography.get_cited_keys(None), [])
+        self.assertEqual(
+            Bibliography.get_cited_keys(
+                'https://www.zotero.org/jsmith/items/ABCD2345'),
+            ['ABCD2345']
+        )
+
+    def test_resolve(self):
+        text = ''.join(
+            self.cite(key) for key in ['ABCD0002', 'ABCD0000', 'ZZZZ9999'])
+
+        with self.assertNumQueries(1):
+            entries = get_bibliography(text)
+        self.assertEqual(
+            [e.key for e in entries], ['ABCD0002', 'ABCD0000'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(get_bibliography(text)), 2)
+
+        entry = Bibliography.objects.get(key='ABCD0000')
+        entry.bib = '<p>Updated</p>'
+        entry.save()
+        with self.assertNumQueries(1):
+            entries = Bibliography.resolve(text)
+        self.assertEqual(entries[1].bib_html, '<p>Updated</p>')
+
+        Bibliography.objects.create(
+            key='ZZZZ9999', item_type='book', order=4, citation='',
+            url='https://example.org/4', bib='')
+        # the import invalidates all the entries
+        Bibliography.invalidate_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Bibliography.resolve(text)), 3)
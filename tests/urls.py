@@ -3,7 +3,11 @@ from __future__ import unicode_literals, absolute_import
 
 from django.conf.urls import url, include
 
+from kdl_wagtail.core.views import sitemap_xml
+
 
 urlpatterns = [
+    url(r'^(?P<sitemap_file>sitemap(-\d+)?\.xml)$', sitemap_xml),
+    url(r'^pages/', include('wagtail.core.urls')),
     url(r'^', include('kdl_wagtail.core.urls', namespace='kdl_wagtail')),
 ]